@@ -1,3 +1,142 @@
-from django.test import TestCase
+import uuid
+from datetime import timedelta
+from urllib.parse import urlparse
 
-# Create your tests here.
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.views import AnalyticsViewSet
+from app.filters import PaginatedRQLFilterBackend
+from app.models import Account, Analytics, User, Visitor
+
+
+class ListQueryCountTests(APITestCase):
+    """
+    The visitor and analytics listings run a fixed number of queries
+    whatever the page size, related rows are loaded in bulk.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = Account.objects.create(name='Listed', site='listed.example.com')
+        other_account = Account.objects.create(name='Other', site='other.example.com')
+        cls.user = User.objects.create_user(email='lister@example.com', password='password',
+                                            first_name='List', last_name='Er', account=cls.account)
+
+        visitors = Visitor.objects.bulk_create([
+            Visitor(whatsapp_number=f'92000{index:05}', device_uuid=uuid.uuid4()) for index in range(30)
+        ])
+        cls.account.visitors.add(*visitors)
+        other_account.visitors.add(*visitors[:10])
+        Analytics.objects.bulk_create([
+            Analytics(account=cls.account, visitor=visitors[index % len(visitors)], page_name=f'page-{index % 4}')
+            for index in range(60)
+        ])
+
+    def setUp(self):
+        token = RefreshToken.for_user(self.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def assert_list_queries(self, url, num_queries, **params):
+        for limit in (5, 25):
+            with self.subTest(url=url, limit=limit), self.assertNumQueries(num_queries):
+                response = self.client.get(url, {**params, 'limit': limit})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.data['results']), limit)
+
+    def test_visitor_list_queries(self):
+        # User, account, count, page
+        self.assert_list_queries('/api/v1/visitor/', 4)
+
+    def test_visitor_list_with_analytics_queries(self):
+        # User, account, count, page, analytics of the page
+        self.assert_list_queries('/api/v1/visitor/', 5, analytics='true')
+
+    def test_analytics_list_queries(self):
+        # User, account, count, page, visitors of the page
+        self.assert_list_queries('/api/v1/analytics/', 5)
+
+
+class CursorPaginationTests(APITestCase):
+    """
+    Cursor pages over `(created, id)` with many rows sharing `created`,
+    navigated with the returned links while an RQL filter is applied.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = Account.objects.create(name='Paged', site='paged.example.com')
+        cls.user = User.objects.create_user(email='pager@example.com', password='password',
+                                            first_name='Pag', last_name='Er', account=cls.account)
+        visitor = Visitor.objects.create(whatsapp_number='9300000000', device_uuid=uuid.uuid4())
+        cls.account.visitors.add(visitor)
+
+        # Three distinct times, each shared by many rows
+        now = timezone.now()
+        times = [now - timedelta(minutes=minutes) for minutes in (0, 1, 2)]
+        analytics = Analytics.objects.bulk_create([
+            Analytics(account=cls.account, visitor=visitor, page_name='home' if index % 3 else 'about',
+                      created=times[index % len(times)])
+            for index in range(40)
+        ])
+        matching = [row for row in analytics if row.page_name == 'home']
+        cls.expected_ids = [row.id for row in sorted(matching, key=lambda row: (row.created, row.id), reverse=True)]
+
+    def setUp(self):
+        token = RefreshToken.for_user(self.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def get_page(self, url):
+        parsed = urlparse(url)
+        response = self.client.get(f'{parsed.path}?{parsed.query}')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_next_and_previous_links(self):
+        page = self.get_page('/api/v1/analytics/?page_name=home&pagination=cursor&limit=4')
+        pages = [[row['id'] for row in page['results']]]
+        self.assertIsNone(page['previous'])
+        while page['next']:
+            page = self.get_page(page['next'])
+            pages.append([row['id'] for row in page['results']])
+
+        self.assertEqual([row_id for ids in pages for row_id in ids], self.expected_ids)
+        self.assertTrue(all(len(ids) == 4 for ids in pages[:-1]))
+
+        previous_pages = [pages[-1]]
+        while page['previous']:
+            page = self.get_page(page['previous'])
+            previous_pages.append([row['id'] for row in page['results']])
+        self.assertEqual(previous_pages[::-1], pages)
+
+    def test_estimated_count(self):
+        page = self.get_page('/api/v1/analytics/?page_name=home&pagination=cursor&count=estimate')
+        self.assertIn('estimated_count', page)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/v1/analytics/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+
+class PaginatedRQLQueryTests(APITestCase):
+    """
+    Only the parameters read by the paginator of a listing are left out of its RQL query.
+    """
+
+    def get_query(self, query_string, action='list'):
+        request = Request(APIRequestFactory().get(f'/api/v1/analytics/?{query_string}'))
+        view = AnalyticsViewSet(action=action, request=request, format_kwarg=None)
+        return PaginatedRQLFilterBackend.get_query(None, request, view)
+
+    def test_limit_offset_listing(self):
+        self.assertEqual(self.get_query('page_name=home&limit=5&offset=10&count=3'), 'page_name=home&count=3')
+
+    def test_cursor_listing(self):
+        query = self.get_query('and(page_name=home,ne(device,x))&pagination=cursor&limit=5&count=estimate')
+        self.assertEqual(query, 'and(page_name=home,ne(device,x))')
+        self.assertEqual(self.get_query('page_name=home&cursor=abc&offset=1'), 'page_name=home&offset=1')
+
+    def test_views_not_paginating(self):
+        self.assertEqual(self.get_query('page_name=home&limit=5', action='export'), 'page_name=home&limit=5')
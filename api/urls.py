@@ -12,6 +12,7 @@ router.register(r'users', views.UserViewSet, basename='users')
 router.register(r'account', views.AccountViewSet, basename='account')
 router.register(r'visitor', views.VisitorViewSet, basename='visitor')
 router.register(r'analytics', views.AnalyticsViewSet, basename='analytics')
+router.register(r'analytics-exports', views.AnalyticsExportViewset, basename='analytics-exports')
 router.register(r'segmentations', views.SegmentationViewset, basename='segmentations')
 router.register(r'campaigns', views.CampaignViewset, basename='campaigns')
 router.register(r'messages', views.MessageViewset, basename='messages')
@@ -24,7 +25,9 @@ urlpatterns = [
 
     path('register/', views.RegisterAPIView.as_view(), name='register-view'),
     path('visitor/report/', views.VisitorReportAPIView.as_view(), name='visitor-report'),
+    path('visitor/report/batch/', views.VisitorBatchReportAPIView.as_view(), name='visitor-report-batch'),
     path('analytics/ingest/', views.AnalyticsIngestionAPIView.as_view(), name='analytics-ingest'),
+    path('analytics/ingest/batch/', views.AnalyticsBatchIngestionAPIView.as_view(), name='analytics-ingest-batch'),
 
     path('wati/auth/', views.WatiAuthAPIView.as_view(), name='wati-auth'),
     # path('wati/events/', views.WatiEventsAPIView.as_view(), name='wati-events'),
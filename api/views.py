@@ -1,20 +1,28 @@
+import os
+
 from django.contrib.auth import get_user_model
+from django.core.files.storage import FileSystemStorage
+from django.http import FileResponse, HttpResponseRedirect, StreamingHttpResponse
 from rest_framework import viewsets, views
 from rest_framework import permissions
-from rest_framework import status
+from rest_framework import serializers, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
 
-from app import custom_permissions
+from app import custom_exceptions, custom_permissions
+from app import exports
 from app import filters
+from app.pagination import LimitOffsetOrCursorPagination
 from app.viewsets import ServiceModelViewset
-from app.models import (Account, Visitor, Analytics,
+from app.models import (Account, Visitor, Analytics, AnalyticsRollup, AnalyticsDimension, AnalyticsExport,
                         Segmentation, Campaign, Message)
 from app.serializers import (UserSerializer, AccountSerializer, VisitorSerializer,
                              VisitorWithAnalyticsSerializer, AnalyticsSerializer,
-                             AnalyticsWithVisitorSerializer, SegmentationSerializer,
+                             AnalyticsWithVisitorSerializer, AnalyticsTimeseriesQuerySerializer,
+                             AnalyticsExportSerializer,
+                             SegmentationSerializer,
                              CampaignSerializer, MessageSerializer, WatiTemplateSerializer)
-from app.services import (AccountRegistrationService, VisitorService, AnalyticsService,
+from app.services import (AccountRegistrationService, VisitorService, AnalyticsService, AnalyticsExportService,
                           SegmentationService, WatiService, CampaignService, MessageService,
                           WatiTemplate)
 from app.swagger_schemas import register_api_schema
@@ -57,9 +65,13 @@ class VisitorViewSet(viewsets.ReadOnlyModelViewSet):
 
     If the query parameter 'analytics' is set to 'true', the response will include analytics
     data related to the visitors. Otherwise, only visitor data will be returned.
+
+    Listings are paginated by limit/offset, `?pagination=cursor` switches to
+    cursor pagination ordered by `(created, id)` without a total count.
     """
     model = Visitor
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = LimitOffsetOrCursorPagination
 
     def get_queryset(self):
         account = get_current_account()
@@ -82,11 +94,14 @@ class VisitorViewSet(viewsets.ReadOnlyModelViewSet):
 class AnalyticsViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows analytics to be viewed.
+
+    Supports the same opt-in cursor pagination as `VisitorViewSet`.
     """
     model = Analytics
     serializer_class = AnalyticsWithVisitorSerializer
     permission_classes = [permissions.IsAuthenticated]
     rql_filter_class = filters.AnalyticsFilters
+    pagination_class = LimitOffsetOrCursorPagination
 
     def get_queryset(self):
         account = get_current_account()
@@ -96,15 +111,86 @@ class AnalyticsViewSet(viewsets.ReadOnlyModelViewSet):
     @action(detail=False, methods=['GET'], rql_filter_class=[])
     def distinct_page_names(self, request):
         account = get_current_account()
-        page_names = Analytics.objects.get_distinct_page_names_for_account(account=account)
+        page_names = AnalyticsDimension.objects.get_values_for_account(account=account,
+                                                                     dimension=AnalyticsDimension.PAGE_NAME,
+                                                                     prefix=request.query_params.get('search'))
         return Response(data=page_names)
 
     @action(detail=False, methods=['GET'], rql_filter_class=[])
     def distinct_button_clicked(self, request):
         account = get_current_account()
-        button_clicked = Analytics.objects.get_distinct_button_clicked_for_account(account=account)
+        button_clicked = AnalyticsDimension.objects.get_values_for_account(account=account,
+                                                                         dimension=AnalyticsDimension.BUTTON_CLICKED,
+                                                                         prefix=request.query_params.get('search'))
         return Response(data=button_clicked)
 
+    @action(detail=False, methods=['GET'], rql_filter_class=[])
+    def timeseries(self, request):
+        """
+        Event counts per hour or day, read from the analytics rollups.
+        Accepts `granularity` (hour or day), `start`, `end` and optional
+        `page_name`, `button_clicked`, `device` and `browser` filters.
+        """
+        account = get_current_account()
+        query_serializer = AnalyticsTimeseriesQuerySerializer(data=request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+        timeseries = AnalyticsRollup.objects.get_timeseries_for_account(account=account,
+                                                                        **query_serializer.validated_data)
+        return Response(data=timeseries)
+
+    @action(detail=False, methods=['GET'])
+    def export(self, request):
+        """
+        Stream every analytics row matching the RQL query as NDJSON, or CSV
+        with `output=csv`. `gzip=true` compresses the stream. Exports too large
+        for a single request can be run in the background with `analytics-exports`.
+        """
+        file_format = request.query_params.get('output', exports.NDJSON).lower()
+        if file_format not in exports.CONTENT_TYPES:
+            raise serializers.ValidationError({'output': f'Must be one of {", ".join(exports.CONTENT_TYPES)}.'})
+        compress = request.query_params.get('gzip', 'false').lower() == 'true'
+
+        queryset = self.filter_queryset(self.get_queryset())
+        if not queryset.ordered:
+            queryset = queryset.order_by('id')
+
+        response = StreamingHttpResponse(exports.stream_analytics(queryset, file_format, compress=compress),
+                                         content_type=exports.get_export_content_type(file_format, compress=compress))
+        file_name = exports.get_export_file_name('analytics', file_format, compress=compress)
+        response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+        return response
+
+
+class AnalyticsExportViewset(ServiceModelViewset):
+    """
+    Background exports of analytics, see `AnalyticsViewSet.export` for the streamed one.
+    """
+    model = AnalyticsExport
+    serializer_class = AnalyticsExportSerializer
+    service_class = AnalyticsExportService
+    permission_classes = [permissions.IsAuthenticated]
+    http_method_names = ['get', 'post', 'head', 'options']
+
+    def get_queryset(self):
+        account = get_current_account()
+        return self.model.objects.filter(account=account).order_by('-created')
+
+    @action(detail=True, methods=['GET'])
+    def download(self, request, pk=None):
+        """
+        Redirect to a signed URL of the file when it is kept in remote storage,
+        otherwise stream it from the local filesystem.
+        """
+        analytics_export = self.get_object()
+        if analytics_export.state != AnalyticsExport.COMPLETED_STATE:
+            raise custom_exceptions.AnalyticsExportNotReady
+        if not isinstance(analytics_export.file.storage, FileSystemStorage):
+            return HttpResponseRedirect(analytics_export.file.url)
+        return FileResponse(analytics_export.file.open('rb'), as_attachment=True,
+                            filename=os.path.basename(analytics_export.file.name),
+                            content_type=exports.get_export_content_type(analytics_export.file_format,
+                                                                         compress=analytics_export.compress))
+
 
 class SegmentationViewset(ServiceModelViewset):
     model = Segmentation
@@ -114,7 +200,7 @@ class SegmentationViewset(ServiceModelViewset):
 
     def get_queryset(self):
         account = get_current_account()
-        queryset = Segmentation.objects.get_segmentation_for_account(account=account)
+        queryset = Segmentation.objects.get_segmentation_with_visitor_count_for_account(account=account)
         return queryset
 
 
@@ -198,6 +284,25 @@ class VisitorReportAPIView(views.APIView):
                         status=status.HTTP_200_OK)
 
 
+class VisitorBatchReportAPIView(views.APIView):
+    """
+    API view for reporting a list of visitors in one request.
+    """
+
+    model = Visitor
+    serializer_class = VisitorSerializer
+    permission_classes = [custom_permissions.AnonymousFromRegisteredSitePermission]
+
+    def post(self, request):
+        visitors_data = request.data
+        reported, already_reported, errors = VisitorService.report_visitors(visitors_data=visitors_data)
+        return Response({'detail': 'Visitors reported.',
+                         'reported': reported,
+                         'already_reported': already_reported,
+                         'errors': errors},
+                        status=status.HTTP_200_OK)
+
+
 class AnalyticsIngestionAPIView(views.APIView):
     """
     API view for ingesting analytics.
@@ -209,11 +314,46 @@ class AnalyticsIngestionAPIView(views.APIView):
 
     def post(self, request):
         analytics_data = request.data
+        if AnalyticsService.can_buffer_analytics():
+            AnalyticsService.buffer_analytics(analytics_data=analytics_data)
+            return Response({'detail': 'Analytics data accepted.'},
+                            status=status.HTTP_202_ACCEPTED)
+
         AnalyticsService.ingest_analytics(analytics_data=analytics_data)
         return Response({'detail': 'Analytics data ingested.'},
                         status=status.HTTP_200_OK)
 
 
+class AnalyticsBatchIngestionAPIView(views.APIView):
+    """
+    API view for ingesting a list of analytics events in one request.
+
+    Events that fail validation are skipped and reported back with their
+    index in the request body, the remaining events are still ingested.
+    When write-behind ingestion is enabled the events are buffered and the
+    view responds with 202.
+    """
+
+    model = Analytics
+    serializer_class = AnalyticsSerializer
+    permission_classes = [custom_permissions.AnonymousFromRegisteredSitePermission]
+
+    def post(self, request):
+        events = request.data
+        if AnalyticsService.can_buffer_analytics():
+            accepted, errors = AnalyticsService.buffer_analytics_batch(events=events)
+            return Response({'detail': 'Analytics data accepted.',
+                             'accepted': accepted,
+                             'errors': errors},
+                            status=status.HTTP_202_ACCEPTED)
+
+        analytics, errors = AnalyticsService.ingest_analytics_batch(events=events)
+        return Response({'detail': 'Analytics data ingested.',
+                         'ingested': len(analytics),
+                         'errors': errors},
+                        status=status.HTTP_200_OK)
+
+
 class WatiAuthAPIView(views.APIView):
     """
     API View for authentication with wati
@@ -1,9 +1,9 @@
-from urllib.parse import urlparse
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
 from django.contrib.auth.models import AnonymousUser
 
-from app.tenant import set_current_account
+from app.caches import get_account_site_cache
+from app.tenant import set_current_account, get_request_site
 
 from app.models import Account
 
@@ -15,15 +15,17 @@ class CustomAuthentication(JWTAuthentication):
             user, jwt_value = authenticated_user
             set_current_account(user.account)
         else:
-            site = request.META.get('HTTP_ORIGIN')
-            if site:
-                parsed_url = urlparse(site)
-                site = parsed_url.netloc.strip()
-            try:
-                account = Account.objects.get(site=site)
-                set_current_account(account)
-                return AnonymousUser(), {}
-            except Account.DoesNotExist:
+            site = get_request_site(request)
+            account = get_account_site_cache().get_account(site, self.get_account_for_site)
+            if account is None:
                 return None
+            set_current_account(account)
+            return AnonymousUser(), {}
 
         return authenticated_user
+
+    def get_account_for_site(self, site):
+        try:
+            return Account.objects.get(site=site)
+        except Account.DoesNotExist:
+            return None
@@ -0,0 +1,327 @@
+import logging
+import threading
+
+import redis
+from cachetools import TTLCache
+from django.conf import settings
+
+from app.redis_client import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+
+class VisitorResolutionCache:
+    """
+    Maps `(account_id, device_uuid)` to the id of a visitor reported for that account.
+
+    Entries live in a bounded in-process LRU cache and, when
+    `VISITOR_CACHE_REDIS_ENABLED` is set, in a shared redis tier so that a
+    visitor resolved by one worker is a hit for every other worker.
+    Only positive lookups are cached. Redis errors are treated as misses.
+
+    With the redis tier, entries of both tiers are keyed by a per-account
+    generation kept in redis and bumped on every invalidation, so a visitor
+    invalidated by one worker stops resolving in all of them (along with the
+    account's other entries, which are resolved again on their next use).
+    Without it, other processes only drop the entry after `VISITOR_CACHE_TTL`.
+    """
+
+    REDIS_KEY = 'visitor:resolve:{account_id}:{generation}:{device_uuid}'
+    GENERATION_KEY = 'visitor:resolve:generation:{account_id}'
+
+    def __init__(self, max_size, ttl, use_redis=False, redis_ttl=None):
+        self.local = TTLCache(maxsize=max_size, ttl=ttl)
+        self.lock = threading.Lock()
+        self.use_redis = use_redis
+        self.redis_ttl = redis_ttl
+
+    def _get_redis_key(self, account_id, generation, device_uuid):
+        return self.REDIS_KEY.format(account_id=account_id, generation=generation, device_uuid=device_uuid)
+
+    def get_generation(self, account_id):
+        """
+        Current generation of the account's entries, None if it can not be read.
+        Read it before resolving visitors from the database and pass it to
+        `set_many`, so results read before an invalidation are not cached after it.
+        """
+        if not self.use_redis:
+            return 0
+        try:
+            return int(get_redis_connection().get(self.GENERATION_KEY.format(account_id=account_id)) or 0)
+        except redis.RedisError as exc:
+            logger.warning(f'Visitor cache redis generation lookup failed: {exc}')
+            return None
+
+    def get_many(self, account_id, device_uuids, generation=None):
+        if generation is None:
+            generation = self.get_generation(account_id)
+        if generation is None:
+            return {}
+
+        found, missing = {}, []
+        with self.lock:
+            for device_uuid in device_uuids:
+                visitor_id = self.local.get((account_id, generation, str(device_uuid)))
+                if visitor_id is None:
+                    missing.append(device_uuid)
+                else:
+                    found[device_uuid] = visitor_id
+
+        if missing and self.use_redis:
+            try:
+                keys = [self._get_redis_key(account_id, generation, device_uuid) for device_uuid in missing]
+                values = get_redis_connection().mget(keys)
+            except redis.RedisError as exc:
+                logger.warning(f'Visitor cache redis lookup failed: {exc}')
+                values = []
+            shared = {device_uuid: int(value) for device_uuid, value in zip(missing, values) if value is not None}
+            self._set_local(account_id, generation, shared)
+            found.update(shared)
+
+        return found
+
+    def get(self, account_id, device_uuid):
+        return self.get_many(account_id, [device_uuid]).get(device_uuid)
+
+    def _set_local(self, account_id, generation, visitor_ids):
+        with self.lock:
+            for device_uuid, visitor_id in visitor_ids.items():
+                self.local[(account_id, generation, str(device_uuid))] = visitor_id
+
+    def set_many(self, account_id, visitor_ids, generation=None):
+        if generation is None:
+            generation = self.get_generation(account_id)
+        if generation is None or not visitor_ids:
+            return
+        self._set_local(account_id, generation, visitor_ids)
+
+        if self.use_redis:
+            try:
+                pipeline = get_redis_connection().pipeline(transaction=False)
+                for device_uuid, visitor_id in visitor_ids.items():
+                    pipeline.set(self._get_redis_key(account_id, generation, device_uuid), visitor_id,
+                                 ex=self.redis_ttl)
+                pipeline.execute()
+            except redis.RedisError as exc:
+                logger.warning(f'Visitor cache redis update failed: {exc}')
+
+    def set(self, account_id, device_uuid, visitor_id):
+        self.set_many(account_id, {device_uuid: visitor_id})
+
+    def invalidate_many(self, account_id, device_uuids):
+        if not device_uuids:
+            return
+        generation = self.get_generation(account_id)
+        with self.lock:
+            for device_uuid in device_uuids:
+                self.local.pop((account_id, generation, str(device_uuid)), None)
+
+        if self.use_redis:
+            try:
+                get_redis_connection().incr(self.GENERATION_KEY.format(account_id=account_id))
+            except redis.RedisError as exc:
+                logger.warning(f'Visitor cache redis invalidation failed: {exc}')
+
+    def invalidate(self, account_id, device_uuid):
+        self.invalidate_many(account_id, [device_uuid])
+
+
+class AccountSiteCache:
+    """
+    Maps a registered site (the netloc of a request's Origin header) to its `Account`.
+
+    Unknown sites are cached as well, for a shorter time, so requests from
+    unregistered origins do not reach the database on every call.
+
+    Entries are keyed by a generation kept in redis and bumped by `clear`
+    whenever an account is saved or deleted, so every process stops serving
+    the old mapping at once. When the generation can not be read from redis
+    accounts are loaded from the database without being cached.
+    """
+
+    GENERATION_KEY = 'account:site:generation'
+
+    def __init__(self, max_size, ttl, negative_ttl):
+        self.accounts = TTLCache(maxsize=max_size, ttl=ttl)
+        self.unknown_sites = TTLCache(maxsize=max_size, ttl=negative_ttl)
+        self.lock = threading.Lock()
+
+    def get_generation(self):
+        try:
+            return int(get_redis_connection().get(self.GENERATION_KEY) or 0)
+        except redis.RedisError as exc:
+            logger.warning(f'Account site cache redis generation lookup failed: {exc}')
+            return None
+
+    def get_account(self, site, loader):
+        """
+        Return the cached account for `site`, calling `loader(site)` on a miss.
+        `loader` should return `None` for sites that are not registered.
+        """
+        generation = self.get_generation()
+        if generation is None:
+            return loader(site)
+
+        key = (generation, site)
+        with self.lock:
+            if key in self.unknown_sites:
+                return None
+            account = self.accounts.get(key)
+        if account is not None:
+            return account
+
+        # Cached under the generation read before loading, so a change made
+        # while loading is not hidden by the entry
+        account = loader(site)
+        with self.lock:
+            if account is None:
+                self.unknown_sites[key] = True
+            else:
+                self.accounts[key] = account
+        return account
+
+    def clear(self):
+        with self.lock:
+            self.accounts.clear()
+            self.unknown_sites.clear()
+        try:
+            get_redis_connection().incr(self.GENERATION_KEY)
+        except redis.RedisError as exc:
+            logger.warning(f'Account site cache redis invalidation failed: {exc}')
+
+
+class MessageTreeCache:
+    """
+    Maps a campaign id to the `MessageTree` of its messages, so webhook
+    processing resolves follow up messages without querying the tree.
+
+    Trees are keyed by a per-campaign version kept in redis and bumped by
+    `invalidate` whenever a message of the campaign changes, so the workers
+    processing webhooks load the new tree as soon as the change is committed.
+    When the version can not be read from redis the tree is loaded without
+    being cached.
+    """
+
+    VERSION_KEY = 'message:tree:version:{campaign_id}'
+
+    def __init__(self, max_size, ttl):
+        self.trees = TTLCache(maxsize=max_size, ttl=ttl)
+        self.lock = threading.Lock()
+
+    def get_version(self, campaign_id):
+        try:
+            return int(get_redis_connection().get(self.VERSION_KEY.format(campaign_id=campaign_id)) or 0)
+        except redis.RedisError as exc:
+            logger.warning(f'Message tree cache redis version lookup failed: {exc}')
+            return None
+
+    def get_tree(self, campaign_id, loader):
+        """
+        Return the cached tree of `campaign_id`, calling `loader(campaign_id)` on a miss.
+        """
+        version = self.get_version(campaign_id)
+        if version is None:
+            return loader(campaign_id)
+
+        with self.lock:
+            tree = self.trees.get((campaign_id, version))
+        if tree is not None:
+            return tree
+
+        tree = loader(campaign_id)
+        with self.lock:
+            self.trees[(campaign_id, version)] = tree
+        return tree
+
+    def invalidate(self, campaign_id):
+        try:
+            get_redis_connection().incr(self.VERSION_KEY.format(campaign_id=campaign_id))
+        except redis.RedisError as exc:
+            logger.warning(f'Message tree cache redis invalidation failed: {exc}')
+
+
+class VisitorNameMissCache:
+    """
+    Remembers, in redis, the numbers of an account that have no name in Wati,
+    so the name sync does not look them up again until `ttl` seconds passed.
+    Redis errors are treated as no numbers being remembered.
+    """
+
+    REDIS_KEY = 'visitor:name:miss:{account_id}:{whatsapp_number}'
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def _get_redis_key(self, account_id, whatsapp_number):
+        return self.REDIS_KEY.format(account_id=account_id, whatsapp_number=whatsapp_number)
+
+    def get_misses(self, account_id, whatsapp_numbers):
+        """
+        The numbers of `whatsapp_numbers` that had no name when last looked up.
+        """
+        if not whatsapp_numbers:
+            return set()
+        try:
+            keys = [self._get_redis_key(account_id, whatsapp_number) for whatsapp_number in whatsapp_numbers]
+            values = get_redis_connection().mget(keys)
+        except redis.RedisError as exc:
+            logger.warning(f'Visitor name miss cache lookup failed: {exc}')
+            return set()
+        return {whatsapp_number for whatsapp_number, value in zip(whatsapp_numbers, values) if value is not None}
+
+    def add_misses(self, account_id, whatsapp_numbers):
+        if not whatsapp_numbers or not self.ttl:
+            return
+        try:
+            pipeline = get_redis_connection().pipeline(transaction=False)
+            for whatsapp_number in whatsapp_numbers:
+                pipeline.set(self._get_redis_key(account_id, whatsapp_number), 1, ex=self.ttl)
+            pipeline.execute()
+        except redis.RedisError as exc:
+            logger.warning(f'Visitor name miss cache update failed: {exc}')
+
+
+_visitor_resolution_cache = None
+_account_site_cache = None
+_message_tree_cache = None
+_visitor_name_miss_cache = None
+
+def get_visitor_resolution_cache():
+    global _visitor_resolution_cache
+    if _visitor_resolution_cache is None:
+        _visitor_resolution_cache = VisitorResolutionCache(
+            max_size=settings.VISITOR_CACHE_MAX_SIZE,
+            ttl=settings.VISITOR_CACHE_TTL,
+            use_redis=settings.VISITOR_CACHE_REDIS_ENABLED,
+            redis_ttl=settings.VISITOR_CACHE_REDIS_TTL
+        )
+    return _visitor_resolution_cache
+
+
+def get_account_site_cache():
+    global _account_site_cache
+    if _account_site_cache is None:
+        _account_site_cache = AccountSiteCache(
+            max_size=settings.ACCOUNT_SITE_CACHE_MAX_SIZE,
+            ttl=settings.ACCOUNT_SITE_CACHE_TTL,
+            negative_ttl=settings.ACCOUNT_SITE_CACHE_NEGATIVE_TTL
+        )
+    return _account_site_cache
+
+
+def get_message_tree_cache():
+    global _message_tree_cache
+    if _message_tree_cache is None:
+        _message_tree_cache = MessageTreeCache(
+            max_size=settings.MESSAGE_TREE_CACHE_MAX_SIZE,
+            ttl=settings.MESSAGE_TREE_CACHE_TTL
+        )
+    return _message_tree_cache
+
+
+def get_visitor_name_miss_cache():
+    global _visitor_name_miss_cache
+    if _visitor_name_miss_cache is None:
+        _visitor_name_miss_cache = VisitorNameMissCache(ttl=settings.VISITOR_NAME_MISS_BACKOFF)
+    return _visitor_name_miss_cache
@@ -1,13 +1,13 @@
 from rest_framework.views import exception_handler
 from rest_framework.response import Response
 from rest_framework import status
-from py_rql.exceptions import RQLFilterParsingError
+from py_rql.exceptions import RQLFilterError
 
 def custom_exception_handler(exc, context):
 
     response = exception_handler(exc, context)
 
-    if isinstance(exc, RQLFilterParsingError):
+    if isinstance(exc, RQLFilterError):
         data = {
             'detail': 'Error parsing RQL query.',
             'code': 'rql_parsing_error'
@@ -18,3 +18,21 @@ class WatiConnectionError(APIException):
     status_code = status.HTTP_400_BAD_REQUEST
     default_detail = 'Error connecting with Wati.'
     default_code = 'wati_api_connection_error'
+
+
+class InvalidAnalyticsBatch(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = 'Analytics batch must be a non-empty list of events.'
+    default_code = 'invalid_analytics_batch'
+
+
+class InvalidVisitorBatch(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = 'Visitor batch must be a non-empty list of visitors.'
+    default_code = 'invalid_visitor_batch'
+
+
+class AnalyticsExportNotReady(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Analytics export is not completed.'
+    default_code = 'analytics_export_not_ready'
@@ -1,7 +1,5 @@
-from urllib.parse import urlparse
-
 from rest_framework.permissions import BasePermission
-from app.tenant import get_current_account
+from app.tenant import get_current_account, get_request_site
 
 class AnonymousFromRegisteredSitePermission(BasePermission):
     """
@@ -14,10 +12,7 @@ class AnonymousFromRegisteredSitePermission(BasePermission):
             if not current_account:
                 return False
 
-            site = request.META.get('HTTP_ORIGIN')
-            if site:
-                parsed_url = urlparse(site)
-                site = parsed_url.netloc.strip()
+            site = get_request_site(request)
             return site == current_account.site
 
         return False
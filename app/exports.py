@@ -0,0 +1,86 @@
+import csv
+import io
+import json
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+
+CONTENT_TYPES = {
+    NDJSON: 'application/x-ndjson',
+    CSV: 'text/csv',
+}
+
+# Lines are grouped into chunks of about this size before being written out
+CHUNK_BYTES = 64 * 1024
+
+
+def get_analytics_export_fields():
+    from app.models import Analytics
+    return [field.attname for field in Analytics._meta.concrete_fields if field.name != 'account']
+
+
+def get_export_file_name(name, file_format, compress=False):
+    file_name = f'{name}.{file_format}'
+    return f'{file_name}.gz' if compress else file_name
+
+
+def get_export_content_type(file_format, compress=False):
+    return 'application/gzip' if compress else CONTENT_TYPES[file_format]
+
+
+def iter_ndjson_lines(fields, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def iter_csv_lines(fields, rows):
+    line = io.StringIO()
+    writer = csv.writer(line)
+    writer.writerow(fields)
+    yield line.getvalue()
+    for row in rows:
+        line.seek(0)
+        line.truncate()
+        writer.writerow(row)
+        yield line.getvalue()
+
+
+def iter_chunks(lines):
+    chunk, size = [], 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            yield ''.join(chunk).encode()
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk).encode()
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_analytics(queryset, file_format, compress=False):
+    """
+    Encoded chunks of the analytics rows of `queryset` as NDJSON or CSV.
+    Rows are read through a server side cursor, so memory use does not
+    grow with the size of the export.
+    """
+    fields = get_analytics_export_fields()
+    rows = (queryset.prefetch_related(None).values_list(*fields)
+            .iterator(chunk_size=settings.ANALYTICS_EXPORT_CHUNK_SIZE))
+
+    lines = iter_csv_lines(fields, rows) if file_format == CSV else iter_ndjson_lines(fields, rows)
+    chunks = iter_chunks(lines)
+    return iter_gzip(chunks) if compress else chunks
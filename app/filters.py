@@ -1,7 +1,156 @@
+from threading import Lock
+from urllib.parse import unquote
+
+from cachetools import LRUCache
+from django.conf import settings
+from dj_rql.drf import RQLFilterBackend
 from dj_rql.filter_cls import AutoRQLFilterClass
+from dj_rql.transformer import RQLToDjangoORMTransformer
+from lark.exceptions import LarkError
+from py_rql.exceptions import RQLFilterParsingError
+from py_rql.parser import RQLParser
 
 from app.models import Analytics
+from app.pagination import get_pagination_query_params
+
+
+class _QueryCompiler(RQLToDjangoORMTransformer):
+    """
+    Transformer returning the Q object of the query instead of applying it
+    to the filter's queryset, so it can be reused across querysets. The
+    annotations it would apply are left to `filter_queryset`, by the names
+    of the filters used, kept in `_filtered_props`.
+    """
+
+    def start(self, args):
+        return args[0]
 
 
 class AnalyticsFilters(AutoRQLFilterClass):
     MODEL = Analytics
+
+    _prototype = None
+    _own_field_names = None
+    _compiled_queries = LRUCache(maxsize=settings.RQL_COMPILED_QUERY_CACHE_SIZE)
+    _compiled_queries_lock = Lock()
+
+    @classmethod
+    def for_queryset(cls, queryset):
+        """
+        Filter instance over `queryset` sharing the filter tree, which is
+        introspected from the model only once per process and class.
+        """
+        # Looked up on the class itself, a subclass has filters of its own
+        prototype = cls.__dict__.get('_prototype')
+        if prototype is None:
+            prototype = cls._prototype = cls(cls.MODEL.objects.none())
+        return cls(queryset, instance=prototype)
+
+    @classmethod
+    def compile_query(cls, query):
+        """
+        Parse `query` and build its Q object, cached per process by query text.
+        Returns `(q, ordering, distinct, filter_names)`, `filter_names` being the
+        filters whose annotations the Q object needs. Raises the same RQL errors
+        as `apply_filters`.
+        """
+        with cls._compiled_queries_lock:
+            compiled = cls._compiled_queries.get((cls, query))
+        if compiled is not None:
+            return compiled
+
+        filter_instance = cls.for_queryset(cls.MODEL.objects.none())
+        compiler = _QueryCompiler(filter_instance)
+        try:
+            q = compiler.transform(RQLParser.parse_query(query))
+        except LarkError as e:
+            # Same unwrapping of the transformer errors as `apply_filters`
+            if not isinstance(e.orig_exc, (AssertionError, LarkError)):
+                raise e.orig_exc
+            raise RQLFilterParsingError()
+
+        compiled = (q, compiler.ordering_filters, filter_instance._is_distinct,
+                    frozenset(compiler._filtered_props))
+        with cls._compiled_queries_lock:
+            cls._compiled_queries[(cls, query)] = compiled
+        return compiled
+
+    @classmethod
+    def filter_queryset(cls, queryset, query):
+        """
+        Apply the RQL `query` to `queryset` using the compiled query cache.
+        """
+        if not query:
+            return queryset
+
+        q, ordering, distinct, filter_names = cls.compile_query(query)
+        filter_instance = cls.for_queryset(queryset)
+        queryset = filter_instance.apply_annotations(filter_names, queryset)
+        queryset = filter_instance._apply_ordering(queryset.filter(q), ordering)
+        if distinct:
+            queryset = queryset.distinct()
+        return queryset
+
+    @classmethod
+    def get_own_field_names(cls):
+        own_field_names = cls.__dict__.get('_own_field_names')
+        if own_field_names is None:
+            own_field_names = cls._own_field_names = frozenset(
+                field.name for field in cls.MODEL._meta.concrete_fields if not field.is_relation
+            )
+        return own_field_names
+
+    @classmethod
+    def is_additive_query(cls, query):
+        """
+        Whether the set of visitors matched by `query` can only grow as new
+        analytics are ingested. Analytics rows are never updated, so this holds
+        when the query only uses the row's own (non relational) fields. The
+        filters used are read from the compiled query cache.
+        """
+        if not query:
+            return True
+        filter_names = cls.compile_query(query)[3]
+        return filter_names <= cls.get_own_field_names()
+
+
+class PaginatedRQLFilterBackend(RQLFilterBackend):
+    """
+    `RQLFilterBackend` leaving the parameters read by the pagination out of
+    the RQL query of paginated listings. Only the parameters the view's
+    paginator reads for the request are left out, and cursors need not be
+    valid RQL. Other views get the whole query string.
+    """
+
+    @classmethod
+    def get_query(cls, filter_instance, request, view):
+        paginator = getattr(view, 'paginator', None)
+        if paginator is None or getattr(view, 'action', None) != 'list':
+            return super().get_query(filter_instance, request, view)
+
+        query_string = request._request.META['QUERY_STRING']
+        pagination_query_params = get_pagination_query_params(paginator, request)
+        terms = [
+            term for term in cls.split_query_terms(query_string)
+            if unquote(term.split('=', 1)[0]) not in pagination_query_params
+        ]
+        return unquote('&'.join(terms))
+
+    @staticmethod
+    def split_query_terms(query_string):
+        """
+        Split the query string on the `&` that are not inside an RQL call.
+        """
+        terms, term, depth = [], [], 0
+        for char in query_string:
+            if char == '&' and depth == 0:
+                terms.append(''.join(term))
+                term = []
+                continue
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth = max(depth - 1, 0)
+            term.append(char)
+        terms.append(''.join(term))
+        return [term for term in terms if term]
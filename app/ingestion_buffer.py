@@ -0,0 +1,129 @@
+import json
+import os
+import socket
+import time
+from datetime import datetime, timezone as dt_timezone
+
+import redis
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from app.redis_client import get_redis_connection
+
+
+class AnalyticsIngestionBuffer:
+    """
+    Write-behind buffer for analytics events backed by one redis stream per account.
+
+    Events are appended by the ingestion views and drained into the database
+    by a consumer group. Entries are acknowledged only after they are written,
+    so an entry read by a worker that died is claimed again by the next drain
+    (at-least-once delivery). Every entry carries the time it was received,
+    which becomes the event's `created` however late it is drained.
+    """
+
+    STREAM_KEY = 'analytics:ingest:{account_id}'
+    ACCOUNTS_KEY = 'analytics:ingest:accounts'
+    GROUP_NAME = 'analytics-drain'
+
+    def __init__(self, connection=None):
+        self.connection = connection or get_redis_connection()
+        self.consumer_name = f'{socket.gethostname()}-{os.getpid()}'
+
+    def get_stream_key(self, account_id):
+        return self.STREAM_KEY.format(account_id=account_id)
+
+    def get_account_ids(self):
+        return [int(account_id) for account_id in self.connection.smembers(self.ACCOUNTS_KEY)]
+
+    def length(self, account_id):
+        return self.connection.xlen(self.get_stream_key(account_id))
+
+    def append(self, account_id, events):
+        stream_key = self.get_stream_key(account_id)
+        received = timezone.now().isoformat()
+        pipeline = self.connection.pipeline(transaction=False)
+        for event in events:
+            pipeline.xadd(stream_key, {'event': json.dumps(event, cls=DjangoJSONEncoder), 'received': received})
+        pipeline.sadd(self.ACCOUNTS_KEY, account_id)
+        return pipeline.execute()[:-1]
+
+    def _ensure_group(self, stream_key):
+        try:
+            self.connection.xgroup_create(stream_key, self.GROUP_NAME, id='0', mkstream=True)
+        except redis.ResponseError as exc:
+            if 'BUSYGROUP' not in str(exc):
+                raise
+
+    @staticmethod
+    def get_received_time(entry_id, fields):
+        """
+        Time the entry was received. Entries buffered without it fall back to
+        the time redis added them, which is encoded in the entry id.
+        """
+        if fields.get('received'):
+            return parse_datetime(fields['received'])
+        timestamp_ms = int(entry_id.split('-')[0])
+        return datetime.fromtimestamp(timestamp_ms / 1000, tz=dt_timezone.utc)
+
+    def read(self, account_id, count):
+        """
+        Return up to `count` `(entry_id, event, received)` tuples for the account.
+        Entries left pending by a dead consumer for longer than
+        `ANALYTICS_INGEST_CLAIM_IDLE_MS` are claimed before new ones are read.
+        """
+        stream_key = self.get_stream_key(account_id)
+        self._ensure_group(stream_key)
+
+        _, entries, *_ = self.connection.xautoclaim(stream_key, self.GROUP_NAME, self.consumer_name,
+                                                    min_idle_time=settings.ANALYTICS_INGEST_CLAIM_IDLE_MS,
+                                                    count=count)
+        entries = [entry for entry in entries if entry and entry[1]]
+        if not entries:
+            response = self.connection.xreadgroup(self.GROUP_NAME, self.consumer_name,
+                                                  {stream_key: '>'}, count=count)
+            entries = response[0][1] if response else []
+
+        return [(entry_id, json.loads(fields['event']), self.get_received_time(entry_id, fields))
+                for entry_id, fields in entries]
+
+    def ack(self, account_id, entry_ids):
+        if not entry_ids:
+            return
+        stream_key = self.get_stream_key(account_id)
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.xack(stream_key, self.GROUP_NAME, *entry_ids)
+        pipeline.xdel(stream_key, *entry_ids)
+        pipeline.execute()
+
+    def delete(self, account_id):
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.delete(self.get_stream_key(account_id))
+        pipeline.srem(self.ACCOUNTS_KEY, account_id)
+        pipeline.execute()
+
+    def get_stats(self, account_id):
+        """
+        Backpressure metrics for the account's stream: number of buffered
+        entries, entries read but not yet acknowledged and the age in
+        seconds of the oldest buffered entry.
+        """
+        stream_key = self.get_stream_key(account_id)
+        self._ensure_group(stream_key)
+
+        length = self.connection.xlen(stream_key)
+        pending = self.connection.xpending(stream_key, self.GROUP_NAME)['pending']
+        oldest = self.connection.xrange(stream_key, count=1)
+        oldest_age = 0
+        if oldest:
+            oldest_timestamp_ms = int(oldest[0][0].split('-')[0])
+            oldest_age = max(time.time() - oldest_timestamp_ms / 1000, 0)
+
+        return {
+            'account_id': account_id,
+            'length': length,
+            'pending': pending,
+            'oldest_age_seconds': round(oldest_age, 3)
+        }
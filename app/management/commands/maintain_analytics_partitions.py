@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from app.partitions import maintain_analytics_partitions
+
+
+class Command(BaseCommand):
+    """
+    Create upcoming analytics partitions and detach or drop expired ones.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=None,
+                            help='Number of months to create partitions ahead of the current one.')
+        parser.add_argument('--retention-months', type=int, default=None,
+                            help='Months of analytics to keep, 0 keeps everything.')
+        parser.add_argument('--drop', action='store_true', default=None,
+                            help='Drop expired partitions instead of detaching them.')
+
+    def handle(self, *args, **options):
+        created, removed = maintain_analytics_partitions(
+            months_ahead=options['months_ahead'],
+            retention_months=options['retention_months'],
+            drop=options['drop']
+        )
+        self.stdout.write(self.style.SUCCESS(f'Created partitions: {", ".join(created) or "-"}'))
+        self.stdout.write(self.style.SUCCESS(f'Removed partitions: {", ".join(removed) or "-"}'))
@@ -3,7 +3,9 @@ from django.db import transaction
 
 from django_celery_beat.models import PeriodicTask, CrontabSchedule
 
-from app.tasks import update_wati_template, sync_visitors_for_segmentation, sync_visitors_name
+from app.tasks import (update_wati_template, sync_visitors_for_segmentation, sync_visitors_name,
+                       drain_analytics_ingestion_buffer, maintain_analytics_partitions, rollup_analytics,
+                       dispatch_due_messages)
 
 
 class Command(BaseCommand):
@@ -26,6 +28,30 @@ class Command(BaseCommand):
             month_of_year='*'
         )
 
+        cron_every_minute = CrontabSchedule.objects.create(
+            minute='*',
+            hour='*',
+            day_of_week='*',
+            day_of_month='*',
+            month_of_year='*'
+        )
+
+        cron_every_5_minutes = CrontabSchedule.objects.create(
+            minute='*/5',
+            hour='*',
+            day_of_week='*',
+            day_of_month='*',
+            month_of_year='*'
+        )
+
+        cron_every_day = CrontabSchedule.objects.create(
+            minute='0',
+            hour='0',
+            day_of_week='*',
+            day_of_month='*',
+            month_of_year='*'
+        )
+
         periodic_tasks_data = [
             {
                 'task': update_wati_template,
@@ -44,6 +70,30 @@ class Command(BaseCommand):
                 'name': 'Task to sync visitors name',
                 'schedule': cron_every_15_minutes,
                 'expire_seconds': 60
+            },
+            {
+                'task': drain_analytics_ingestion_buffer,
+                'name': 'Task to drain analytics ingestion buffer',
+                'schedule': cron_every_minute,
+                'expire_seconds': 60
+            },
+            {
+                'task': maintain_analytics_partitions,
+                'name': 'Task to maintain analytics partitions',
+                'schedule': cron_every_day,
+                'expire_seconds': 3600
+            },
+            {
+                'task': rollup_analytics,
+                'name': 'Task to rollup analytics',
+                'schedule': cron_every_5_minutes,
+                'expire_seconds': 300
+            },
+            {
+                'task': dispatch_due_messages,
+                'name': 'Task to dispatch due messages',
+                'schedule': cron_every_minute,
+                'expire_seconds': 60
             }
         ]
         for periodic_task in periodic_tasks_data:
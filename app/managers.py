@@ -1,6 +1,11 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth.models import BaseUserManager
-from django.db.models import Q
-from django.db import models
+from django.db.models import F, Func, Q, Value
+from django.db import connections, models, transaction
+from django.utils import timezone
 
 from app.querysets import VisitorQuerySet
 from app.tenant import get_current_account
@@ -56,6 +61,69 @@ class VisitorManager(models.Manager):
         visitor.account.add(account)
         return visitor
 
+    def upsert_visitors(self, visitors_data):
+        """
+        Insert the visitors whose `device_uuid` does not exist yet with a single
+        `INSERT ... ON CONFLICT DO NOTHING` and return a dict of device_uuid ->
+        visitor id for every given device. Existing visitors are not written to,
+        their ids are read back with a separate select.
+        """
+        visitors_data = list({data['device_uuid']: data for data in visitors_data}.values())
+        if not visitors_data:
+            return {}
+
+        now = timezone.now()
+        params = []
+        for data in visitors_data:
+            params.extend([data.get('name'), data['whatsapp_number'], data['device_uuid'], now, now])
+        values = ', '.join(['(%s, %s, %s, %s, %s)'] * len(visitors_data))
+
+        sql = (
+            f'INSERT INTO {self.model._meta.db_table} (name, whatsapp_number, device_uuid, created, updated) '
+            f'VALUES {values} '
+            'ON CONFLICT (device_uuid) DO NOTHING '
+            'RETURNING device_uuid, id'
+        )
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            visitor_ids = dict(cursor.fetchall())
+
+        # Run as its own statement so that rows committed by a concurrent
+        # insert of the same device are visible to it.
+        existing_device_uuids = [
+            data['device_uuid'] for data in visitors_data if data['device_uuid'] not in visitor_ids
+        ]
+        if existing_device_uuids:
+            visitor_ids.update(
+                self.filter(device_uuid__in=existing_device_uuids).values_list('device_uuid', 'id')
+            )
+        return visitor_ids
+
+    def add_visitors_to_account(self, visitor_ids, account):
+        """
+        Add visitors to the account, ignoring the ones already in it.
+        Returns the ids of the visitors that were added.
+        """
+        visitor_ids = list(visitor_ids)
+        if not visitor_ids:
+            return []
+
+        through = self.model.account.through
+        params = []
+        for visitor_id in visitor_ids:
+            params.extend([visitor_id, account.id])
+        values = ', '.join(['(%s, %s)'] * len(visitor_ids))
+
+        sql = (
+            f'INSERT INTO {through._meta.db_table} (visitor_id, account_id) '
+            f'VALUES {values} '
+            'ON CONFLICT (visitor_id, account_id) DO NOTHING '
+            'RETURNING visitor_id'
+        )
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
     def add_visitor_to_current_account(self, visitor):
         account = get_current_account()
         visitor.account.add(account)
@@ -64,11 +132,15 @@ class VisitorManager(models.Manager):
     def is_visitor_in_account(self, visitor, account):
         return visitor.account.filter(id=account.id).exists()
 
+    def get_visitor_ids_for_devices_in_account(self, device_uuids, account):
+        visitors = self.get_queryset().for_account(account).filter(device_uuid__in=device_uuids)
+        return dict(visitors.values_list('device_uuid', 'id'))
+
     def get_visitors_for_account(self, account):
-        return self.get_queryset().for_account(account)
+        return self.get_queryset().for_account(account).with_account_membership(account)
 
     def get_visitors_with_analytics_for_account(self, account):
-        return self.get_queryset().with_analytics_for_account(account)
+        return self.get_queryset().with_analytics_for_account(account).with_account_membership(account)
 
     def get_visitors_without_name_for_account(self, account):
         return self.get_queryset().for_account(account=account).filter(
@@ -85,13 +157,47 @@ class AnalyticsManager(models.Manager):
         analytics = self.create(**analytics_data)
         return analytics
 
+    def ingest_analytics_bulk(self, analytics_objs, batch_size=None):
+        return self.bulk_create(analytics_objs, batch_size=batch_size)
+
     def get_analytics_for_account(self, account):
-        return self.filter(account=account).prefetch_related('visitor')
+        from app.models import Visitor
+        return self.filter(account=account).prefetch_related(
+            models.Prefetch('visitor', queryset=Visitor.objects.get_queryset().with_account_membership(account))
+        )
+
+    def get_settled_max_id(self, after_id=0):
+        """
+        Highest id up to which every row is committed, or None if it is not
+        after `after_id`. Incremental jobs stop there so that inserts with
+        lower ids still in flight are not skipped.
+
+        The highest id is checkpointed, and the checkpoint settles once it is
+        `ANALYTICS_SETTLE_SECONDS` old. `created` can not tell this, buffered
+        events are written with the time they were received.
+        """
+        from app.models import AnalyticsWatermark
+        settled_before = timezone.now() - timedelta(seconds=settings.ANALYTICS_SETTLE_SECONDS)
+        with transaction.atomic(using=self.db):
+            watermarks = AnalyticsWatermark.objects.select_for_update()
+            checkpoint, _ = watermarks.get_or_create(name=AnalyticsWatermark.CHECKPOINT)
+            settled, _ = watermarks.get_or_create(name=AnalyticsWatermark.SETTLED)
+            if checkpoint.updated <= settled_before:
+                settled.last_analytics_id = checkpoint.last_analytics_id
+                settled.save()
+                checkpoint.last_analytics_id = self.aggregate(max_id=models.Max('id'))['max_id'] or 0
+                checkpoint.save()
+
+        if settled.last_analytics_id > after_id:
+            return settled.last_analytics_id
+        return None
 
     def get_distinct_page_names_for_account(self, account):
         return self.filter(account=account).values_list('page_name', flat=True).distinct()
 
     def get_distinct_button_clicked_for_account(self, account):
+        # The exclusion compiles to the condition of the partial analytics_account_button_idx,
+        # without it the index can not be used
         return self.filter(account=account).exclude(button_clicked="").values_list('button_clicked', flat=True).distinct()
 
     def get_unique_visitor_for_account(self, account, query=None):
@@ -99,13 +205,96 @@ class AnalyticsManager(models.Manager):
         if not query:
             return queryset
 
-        from app.filters import AnalyticsFilters
-        analytics_filter = AnalyticsFilters(queryset)
-        _, filtered_queryset = analytics_filter.apply_filters(query=query)
-        visitor_ids = [item['visitor'] for item in filtered_queryset.distinct('visitor').values('visitor')]
+        filtered_queryset = self.get_visitor_ids_matching_query_for_account(account=account, query=query)
+        visitor_ids = [item['visitor'] for item in filtered_queryset.distinct('visitor')]
 
         return visitor_ids
 
+    def get_visitor_ids_matching_query_for_account(self, account, query, after_id=None, up_to_id=None):
+        """
+        Unevaluated `values('visitor')` queryset over the account's analytics
+        matching the RQL `query`, optionally limited to an id range.
+        Visitors may repeat.
+        """
+        queryset = self.filter(account=account)
+        if after_id is not None:
+            queryset = queryset.filter(id__gt=after_id)
+        if up_to_id is not None:
+            queryset = queryset.filter(id__lte=up_to_id)
+
+        from app.filters import AnalyticsFilters
+        filtered_queryset = AnalyticsFilters.filter_queryset(queryset, query)
+
+        return filtered_queryset.values('visitor')
+
+
+class AnalyticsRollupManager(models.Manager):
+
+    use_in_migrations = True
+
+    def rollup_analytics_range(self, granularity, from_id, to_id):
+        """
+        Add the counts of the analytics rows with `from_id < id <= to_id`
+        to the rollups of the given granularity.
+        """
+        from app.models import Analytics
+
+        sql = (
+            f'INSERT INTO {self.model._meta.db_table} '
+            '(account_id, granularity, bucket, page_name, button_clicked, device, browser, count) '
+            "SELECT account_id, %s, date_trunc(%s, created AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', "
+            "coalesce(page_name, ''), coalesce(button_clicked, ''), coalesce(device, ''), coalesce(browser, ''), "
+            'count(*) '
+            f'FROM {Analytics._meta.db_table} WHERE id > %s AND id <= %s '
+            'GROUP BY 1, 2, 3, 4, 5, 6, 7 '
+            'ON CONFLICT (account_id, granularity, bucket, page_name, button_clicked, device, browser) '
+            f'DO UPDATE SET count = {self.model._meta.db_table}.count + EXCLUDED.count'
+        )
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, [granularity, granularity, from_id, to_id])
+            return cursor.rowcount
+
+    def get_timeseries_for_account(self, account, granularity, start, end, **dimensions):
+        return (self.filter(account=account, granularity=granularity, bucket__gte=start, bucket__lt=end, **dimensions)
+                .values('bucket')
+                .annotate(count=models.Sum('count'))
+                .order_by('bucket'))
+
+
+class AnalyticsDimensionManager(models.Manager):
+
+    use_in_migrations = True
+
+    def update_dimension_range(self, dimension, from_id, to_id):
+        """
+        Add the values of `dimension` seen in the analytics rows with
+        `from_id < id <= to_id`. Empty values are ignored.
+        """
+        from app.models import Analytics
+
+        column = Analytics._meta.get_field(dimension).column
+        table = self.model._meta.db_table
+        sql = (
+            f'INSERT INTO {table} (account_id, dimension, value, first_seen, last_seen, hit_count) '
+            f'SELECT account_id, %s, {column}, min(created), max(created), count(*) '
+            f'FROM {Analytics._meta.db_table} '
+            f"WHERE id > %s AND id <= %s AND {column} IS NOT NULL AND {column} <> '' "
+            f'GROUP BY account_id, {column} '
+            'ON CONFLICT (account_id, dimension, value) DO UPDATE SET '
+            f'first_seen = LEAST({table}.first_seen, EXCLUDED.first_seen), '
+            f'last_seen = GREATEST({table}.last_seen, EXCLUDED.last_seen), '
+            f'hit_count = {table}.hit_count + EXCLUDED.hit_count'
+        )
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, [dimension, from_id, to_id])
+            return cursor.rowcount
+
+    def get_values_for_account(self, account, dimension, prefix=None):
+        queryset = self.filter(account=account, dimension=dimension)
+        if prefix:
+            queryset = queryset.filter(value__istartswith=prefix)
+        return queryset.order_by('-hit_count', 'value').values_list('value', flat=True)
+
 
 class SegmentationManager(models.Manager):
 
@@ -118,6 +307,46 @@ class SegmentationManager(models.Manager):
     def get_segmentation_for_account(self, account):
         return self.filter(account=account)
 
+    def get_segmentation_with_visitor_count_for_account(self, account):
+        return self.get_segmentation_for_account(account=account).annotate(
+            visitor_count=models.Count('visitorsegmentationmap')
+        )
+
+
+class VisitorSegmentationMapManager(models.Manager):
+
+    use_in_migrations = True
+
+    def sync_visitors(self, segmentation, visitor_ids, remove_missing=False):
+        """
+        Add the visitors of the `visitor_ids` queryset to the segmentation in a
+        single `INSERT ... SELECT ... ON CONFLICT DO NOTHING` and, when
+        `remove_missing` is set, delete the members not in it within the same
+        statement. Returns the ids of the visitors that were added.
+        """
+        table = self.model._meta.db_table
+        subquery, params = visitor_ids.query.sql_with_params()
+
+        sql = f'WITH matched AS (SELECT DISTINCT visitor_id FROM ({subquery}) AS matched_analytics)'
+        params = list(params)
+        if remove_missing:
+            sql += (
+                f', removed AS (DELETE FROM {table} WHERE segmentation_id = %s '
+                'AND visitor_id NOT IN (SELECT visitor_id FROM matched))'
+            )
+            params.append(segmentation.id)
+        sql += (
+            f' INSERT INTO {table} (visitor_id, segmentation_id, created) '
+            'SELECT visitor_id, %s, %s FROM matched '
+            'ON CONFLICT (visitor_id, segmentation_id) DO NOTHING '
+            'RETURNING visitor_id'
+        )
+        params.extend([segmentation.id, timezone.now()])
+
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
 
 class WatiAttributeManager(models.Manager):
 
@@ -131,6 +360,101 @@ class WatiAttributeManager(models.Manager):
         return instance
 
 
+class MessageAudienceBatchManager(models.Manager):
+
+    use_in_migrations = True
+
+    def create_audience_batches(self, message, visitor_ids, send_at):
+        """
+        Split the audience of `message` into batches of `MESSAGE_AUDIENCE_BATCH_SIZE`
+        visitors, scheduled to be sent at `send_at`.
+        """
+        visitor_ids = list(visitor_ids)
+        batch_size = settings.MESSAGE_AUDIENCE_BATCH_SIZE
+        return self.bulk_create([
+            self.model(message=message, visitor_ids=visitor_ids[start:start + batch_size], send_at=send_at)
+            for start in range(0, len(visitor_ids), batch_size)
+        ])
+
+    def claim_due_audience_batches(self, limit):
+        """
+        Mark up to `limit` scheduled batches that are due as dispatched, earliest
+        first, and return their `(message_id, id, dispatch_token)`. Rows locked
+        by a concurrent claim are skipped, so dispatchers never claim the same
+        batch twice. Every claim hands out a new token, only its task may send.
+        """
+        table = self.model._meta.db_table
+        # The due rows are selected once, an `IN (subquery)` can be rescanned by the
+        # join and skip the rows it just updated, claiming more than `limit`
+        sql = (
+            f'WITH due AS MATERIALIZED ('
+            f'SELECT id FROM {table} WHERE state = %s AND send_at <= now() '
+            f'ORDER BY send_at LIMIT %s FOR UPDATE SKIP LOCKED'
+            f') '
+            f'UPDATE {table} SET state = %s, dispatched_at = now(), dispatch_token = %s, updated = now() '
+            f'FROM due WHERE {table}.id = due.id '
+            f'RETURNING {table}.message_id, {table}.id, {table}.dispatch_token'
+        )
+        params = [self.model.SCHEDULED_STATE, limit, self.model.DISPATCHED_STATE, str(uuid.uuid4())]
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            return [(message_id, batch_id, str(token)) for message_id, batch_id, token in cursor.fetchall()]
+
+    def reschedule_stale_audience_batches(self, updated_before):
+        """
+        Put dispatched batches whose task made no progress since `updated_before`
+        back in the scheduled state, for their task was lost or gave up. Their
+        token is dropped, so a task that turns up late can not send any more.
+        Batches dispatched without a time were queued with an eta and are left alone.
+        """
+        return self.get_queryset().filter(
+            state=self.model.DISPATCHED_STATE, dispatched_at__isnull=False, updated__lt=updated_before
+        ).update(state=self.model.SCHEDULED_STATE, dispatched_at=None, dispatch_token=None, updated=timezone.now())
+
+    def _filter_dispatched(self, audience_batch):
+        return self.get_queryset().filter(id=audience_batch.id, state=self.model.DISPATCHED_STATE,
+                                          dispatch_token=audience_batch.dispatch_token)
+
+    def update_dispatched_audience_batch(self, audience_batch, **fields):
+        """
+        Update the batch and touch `updated` if it is still dispatched with the
+        token of `audience_batch`. Returns whether it was, a task whose batch
+        was dispatched again must stop sending.
+        """
+        return bool(self._filter_dispatched(audience_batch).update(updated=timezone.now(), **fields))
+
+    def record_uncertain_visitors(self, audience_batch, sent, visitor_ids):
+        """
+        Move the batch past a chunk that may or may not have been sent, keeping
+        its visitors in `uncertain_visitor_ids`.
+        """
+        return self.update_dispatched_audience_batch(
+            audience_batch, sent=sent,
+            uncertain_visitor_ids=Func(F('uncertain_visitor_ids'), Value(visitor_ids), function='array_cat')
+        )
+
+    def complete_audience_batch(self, audience_batch):
+        return self.update_dispatched_audience_batch(audience_batch, state=self.model.COMPLETED_STATE)
+
+
+class WatiMessageManager(models.Manager):
+
+    use_in_migrations = True
+
+    def create_pending_wati_messages(self, message, visitors):
+        """
+        Record `message` as sent to `visitors` with one insert. The Wati
+        message ids are filled in later by `correlate_wati_messages`.
+        """
+        return self.bulk_create([self.model(message=message, visitor=visitor) for visitor in visitors])
+
+    def get_pending_wati_messages(self, message, wati_message_ids=None):
+        queryset = self.filter(message=message, wati_message_id__isnull=True, correlation_failed=False)
+        if wati_message_ids is not None:
+            queryset = queryset.filter(id__in=wati_message_ids)
+        return queryset.select_related('visitor')
+
+
 class WatiTemplateManager(models.Manager):
 
     use_in_migrations = True
@@ -142,6 +466,22 @@ class WatiTemplateManager(models.Manager):
         return self.get_wati_template_for_account(account=account).delete()
     
 
+class MessageManager(models.Manager):
+
+    use_in_migrations = True
+
+    def load_message_tree_for_campaign(self, campaign_id):
+        from app.message_tree import MessageTree
+        return MessageTree(self.filter(campaign_id=campaign_id).order_by('id'))
+
+    def get_message_tree_for_campaign(self, campaign_id):
+        """
+        The `MessageTree` of the campaign, loaded with a single query and cached.
+        """
+        from app.caches import get_message_tree_cache
+        return get_message_tree_cache().get_tree(campaign_id, self.load_message_tree_for_campaign)
+
+
 class CampaignManager(models.Manager):
 
     use_in_migrations = True
@@ -0,0 +1,57 @@
+from collections import defaultdict
+
+
+class MessageTree:
+    """
+    The messages of a campaign, loaded in one query and linked in memory.
+
+    Messages are indexed by id and by parent, so resolving the head of the
+    campaign or the children of a message for an action needs no queries.
+    Instances are shared through `MessageTreeCache` and must not be modified.
+    """
+
+    def __init__(self, messages):
+        self.messages = {message.id: message for message in messages}
+        self.children = defaultdict(list)
+
+        for message in self.messages.values():
+            parent = self.messages.get(message.parent_id)
+            # Link the instances so `message.parent` does not query either
+            type(message).parent.field.set_cached_value(message, parent)
+            if parent is not None:
+                self.children[parent.id].append(message)
+
+    def __bool__(self):
+        return bool(self.messages)
+
+    def get_message(self, message_id):
+        return self.messages.get(message_id)
+
+    def get_head_message(self, message=None):
+        """
+        Root of the tree of `message`, or of the campaign's first message
+        when no message is given.
+        """
+        if message is None:
+            if not self.messages:
+                return None
+            message = self.messages[min(self.messages)]
+
+        head = self.messages.get(message.id, message)
+        while head.parent_id is not None and head.parent_id in self.messages:
+            head = self.messages[head.parent_id]
+        return head
+
+    def get_children(self, message, action=None):
+        children = self.children.get(message.id, [])
+        if action is None:
+            return list(children)
+        return [child for child in children if child.action == action]
+
+    def get_ancestors(self, message):
+        ancestors = []
+        parent = self.messages.get(message.parent_id)
+        while parent is not None:
+            ancestors.append(parent)
+            parent = self.messages.get(parent.parent_id)
+        return ancestors
@@ -0,0 +1,51 @@
+# Generated by Django 4.1 on 2026-10-18 14:38
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_duplicate_visitors(apps, schema_editor):
+    """
+    Fold visitors sharing a `device_uuid` into the oldest one so that
+    `device_uuid` can be made unique.
+    """
+    Visitor = apps.get_model('app', 'Visitor')
+    Analytics = apps.get_model('app', 'Analytics')
+    WatiMessage = apps.get_model('app', 'WatiMessage')
+    VisitorSegmentationMap = apps.get_model('app', 'VisitorSegmentationMap')
+    VisitorAccount = Visitor.account.through
+
+    duplicates = (Visitor.objects.values('device_uuid')
+                  .annotate(visitor_count=Count('id'), keep_id=Min('id'))
+                  .filter(visitor_count__gt=1))
+
+    for duplicate in duplicates:
+        keep = Visitor.objects.get(id=duplicate['keep_id'])
+        others = Visitor.objects.filter(device_uuid=duplicate['device_uuid']).exclude(id=keep.id)
+
+        Analytics.objects.filter(visitor__in=others).update(visitor=keep)
+        WatiMessage.objects.filter(visitor__in=others).update(visitor=keep)
+
+        for visitor_segmentation_map in VisitorSegmentationMap.objects.filter(visitor__in=others):
+            if VisitorSegmentationMap.objects.filter(visitor=keep,
+                                                     segmentation_id=visitor_segmentation_map.segmentation_id).exists():
+                visitor_segmentation_map.delete()
+            else:
+                visitor_segmentation_map.visitor = keep
+                visitor_segmentation_map.save()
+
+        account_ids = VisitorAccount.objects.filter(visitor__in=others).values_list('account_id', flat=True)
+        for account_id in set(account_ids):
+            VisitorAccount.objects.get_or_create(visitor_id=keep.id, account_id=account_id)
+        others.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_alter_visitor_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_visitors, migrations.RunPython.noop),
+    ]
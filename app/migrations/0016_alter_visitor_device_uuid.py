@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_merge_duplicate_visitors'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='visitor',
+            name='device_uuid',
+            field=models.UUIDField(unique=True),
+        ),
+    ]
@@ -0,0 +1,125 @@
+# Generated by Django 4.1 on 2026-10-18 15:02
+
+from django.db import migrations
+
+
+# `app_analytics` becomes a table partitioned by month on `created`. Postgres
+# requires the partition key in the primary key, so the primary key becomes
+# (id, created); Django keeps treating `id` as the primary key. Monthly
+# partitions are created from the oldest row up to a few months ahead, later
+# ones are created by `app.partitions.maintain_analytics_partitions`.
+PARTITION_ANALYTICS_SQL = """
+ALTER TABLE app_analytics RENAME TO app_analytics_unpartitioned;
+
+CREATE SEQUENCE app_analytics_partitioned_id_seq AS bigint;
+
+CREATE TABLE app_analytics (
+    id bigint NOT NULL DEFAULT nextval('app_analytics_partitioned_id_seq'),
+    browser varchar(64) NULL,
+    device varchar(64) NULL,
+    page_name varchar(128) NULL,
+    page_url varchar(2000) NULL,
+    button_clicked varchar(128) NULL,
+    latitude double precision NULL,
+    longitude double precision NULL,
+    location varchar(128) NULL,
+    timezone varchar(64) NULL,
+    created timestamp with time zone NOT NULL,
+    account_id bigint NOT NULL,
+    visitor_id bigint NOT NULL,
+    time_stayed double precision NULL,
+    CONSTRAINT app_analytics_partitioned_pkey PRIMARY KEY (id, created)
+) PARTITION BY RANGE (created);
+
+ALTER SEQUENCE app_analytics_partitioned_id_seq OWNED BY app_analytics.id;
+
+CREATE TABLE app_analytics_default PARTITION OF app_analytics DEFAULT;
+
+DO $$
+DECLARE
+    partition_start timestamptz;
+    last_start timestamptz;
+BEGIN
+    SELECT date_trunc('month', coalesce(min(created), now()) AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+      INTO partition_start FROM app_analytics_unpartitioned;
+    last_start := (date_trunc('month', now() AT TIME ZONE 'UTC') + interval '3 months') AT TIME ZONE 'UTC';
+    WHILE partition_start <= last_start LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF app_analytics FOR VALUES FROM (%L) TO (%L)',
+            'app_analytics_p' || to_char(partition_start AT TIME ZONE 'UTC', 'YYYY_MM'),
+            partition_start,
+            ((partition_start AT TIME ZONE 'UTC') + interval '1 month') AT TIME ZONE 'UTC'
+        );
+        partition_start := ((partition_start AT TIME ZONE 'UTC') + interval '1 month') AT TIME ZONE 'UTC';
+    END LOOP;
+END $$;
+
+INSERT INTO app_analytics (id, browser, device, page_name, page_url, button_clicked, latitude, longitude,
+                           location, timezone, created, account_id, visitor_id, time_stayed)
+SELECT id, browser, device, page_name, page_url, button_clicked, latitude, longitude,
+       location, timezone, created, account_id, visitor_id, time_stayed
+FROM app_analytics_unpartitioned;
+
+SELECT setval('app_analytics_partitioned_id_seq', coalesce(max(id), 0) + 1, false) FROM app_analytics;
+
+DROP TABLE app_analytics_unpartitioned;
+
+ALTER SEQUENCE app_analytics_partitioned_id_seq RENAME TO app_analytics_id_seq;
+ALTER TABLE app_analytics RENAME CONSTRAINT app_analytics_partitioned_pkey TO app_analytics_pkey;
+
+CREATE INDEX app_analytics_account_id_3212d274 ON app_analytics (account_id);
+CREATE INDEX app_analytics_visitor_id_d4da951b ON app_analytics (visitor_id);
+ALTER TABLE app_analytics ADD CONSTRAINT app_analytics_account_id_3212d274_fk_app_account_id
+    FOREIGN KEY (account_id) REFERENCES app_account (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE app_analytics ADD CONSTRAINT app_analytics_visitor_id_d4da951b_fk_app_visitor_id
+    FOREIGN KEY (visitor_id) REFERENCES app_visitor (id) DEFERRABLE INITIALLY DEFERRED;
+"""
+
+UNPARTITION_ANALYTICS_SQL = """
+ALTER TABLE app_analytics RENAME TO app_analytics_partitioned;
+
+CREATE TABLE app_analytics (
+    id bigint NOT NULL GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    browser varchar(64) NULL,
+    device varchar(64) NULL,
+    page_name varchar(128) NULL,
+    page_url varchar(2000) NULL,
+    button_clicked varchar(128) NULL,
+    latitude double precision NULL,
+    longitude double precision NULL,
+    location varchar(128) NULL,
+    timezone varchar(64) NULL,
+    created timestamp with time zone NOT NULL,
+    account_id bigint NOT NULL,
+    visitor_id bigint NOT NULL,
+    time_stayed double precision NULL
+);
+
+INSERT INTO app_analytics (id, browser, device, page_name, page_url, button_clicked, latitude, longitude,
+                           location, timezone, created, account_id, visitor_id, time_stayed)
+SELECT id, browser, device, page_name, page_url, button_clicked, latitude, longitude,
+       location, timezone, created, account_id, visitor_id, time_stayed
+FROM app_analytics_partitioned;
+
+SELECT setval(pg_get_serial_sequence('app_analytics', 'id'), coalesce(max(id), 0) + 1, false) FROM app_analytics;
+
+DROP TABLE app_analytics_partitioned;
+
+CREATE INDEX app_analytics_account_id_3212d274 ON app_analytics (account_id);
+CREATE INDEX app_analytics_visitor_id_d4da951b ON app_analytics (visitor_id);
+ALTER TABLE app_analytics ADD CONSTRAINT app_analytics_account_id_3212d274_fk_app_account_id
+    FOREIGN KEY (account_id) REFERENCES app_account (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE app_analytics ADD CONSTRAINT app_analytics_visitor_id_d4da951b_fk_app_visitor_id
+    FOREIGN KEY (visitor_id) REFERENCES app_visitor (id) DEFERRABLE INITIALLY DEFERRED;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_alter_visitor_device_uuid'),
+    ]
+
+    operations = [
+        migrations.RunSQL(PARTITION_ANALYTICS_SQL, UNPARTITION_ANALYTICS_SQL),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.1 on 2026-10-18 14:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_partition_analytics'),
+    ]
+
+    operations = [
+        # Only the FK index is dropped, the FK constraint itself is left alone so
+        # it does not need to be revalidated against the whole table.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    'DROP INDEX IF EXISTS "app_analytics_account_id_3212d274";',
+                    'CREATE INDEX "app_analytics_account_id_3212d274" ON "app_analytics" ("account_id");',
+                ),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='analytics',
+                    name='account',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='analytics', to='app.account'),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='analytics',
+            index=models.Index(fields=['account', 'created'], name='analytics_account_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analytics',
+            index=models.Index(fields=['account', 'page_name'], name='analytics_account_page_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analytics',
+            index=models.Index(condition=models.Q(('button_clicked', ''), _negated=True), fields=['account', 'button_clicked'], name='analytics_account_button_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analytics',
+            index=models.Index(fields=['account', 'visitor'], name='analytics_account_visitor_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visitor',
+            index=models.Index(fields=['whatsapp_number'], name='visitor_whatsapp_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='watimessage',
+            index=models.Index(condition=models.Q(('wati_message_id__isnull', False)), fields=['wati_message_id'], name='watimessage_wati_id_idx'),
+        ),
+    ]
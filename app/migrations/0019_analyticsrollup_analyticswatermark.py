@@ -0,0 +1,45 @@
+# Generated by Django 4.1 on 2026-10-18 14:45
+
+import app.managers
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_analytics_visitor_watimessage_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('last_analytics_id', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AnalyticsRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=8)),
+                ('bucket', models.DateTimeField()),
+                ('page_name', models.CharField(blank=True, default='', max_length=128)),
+                ('button_clicked', models.CharField(blank=True, default='', max_length=128)),
+                ('device', models.CharField(blank=True, default='', max_length=64)),
+                ('browser', models.CharField(blank=True, default='', max_length=64)),
+                ('count', models.BigIntegerField(default=0)),
+                ('account', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='analytics_rollups', to='app.account')),
+            ],
+            managers=[
+                ('objects', app.managers.AnalyticsRollupManager()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='analyticsrollup',
+            constraint=models.UniqueConstraint(fields=('account', 'granularity', 'bucket', 'page_name', 'button_clicked', 'device', 'browser'), name='analytics_rollup_unique'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.1 on 2026-10-18 14:46
+
+import app.managers
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Rows already folded into the rollups are not seen again by the rollup job,
+# so their dimension values are backfilled here.
+BACKFILL_DIMENSIONS_SQL = """
+INSERT INTO app_analyticsdimension (account_id, dimension, value, first_seen, last_seen, hit_count)
+SELECT account_id, '%(dimension)s', %(dimension)s, min(created), max(created), count(*)
+FROM app_analytics
+WHERE id <= (SELECT coalesce(max(last_analytics_id), 0) FROM app_analyticswatermark WHERE name = 'rollup')
+  AND %(dimension)s IS NOT NULL AND %(dimension)s <> ''
+GROUP BY account_id, %(dimension)s;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_analyticsrollup_analyticswatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsDimension',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('page_name', 'Page name'), ('button_clicked', 'Button clicked')], max_length=32)),
+                ('value', models.CharField(max_length=128)),
+                ('first_seen', models.DateTimeField()),
+                ('last_seen', models.DateTimeField()),
+                ('hit_count', models.BigIntegerField(default=0)),
+                ('account', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='analytics_dimensions', to='app.account')),
+            ],
+            managers=[
+                ('objects', app.managers.AnalyticsDimensionManager()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='analyticsdimension',
+            constraint=models.UniqueConstraint(fields=('account', 'dimension', 'value'), name='analytics_dimension_unique'),
+        ),
+        migrations.RunSQL(
+            BACKFILL_DIMENSIONS_SQL % {'dimension': 'page_name'},
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            BACKFILL_DIMENSIONS_SQL % {'dimension': 'button_clicked'},
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1 on 2026-10-18 14:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_analyticsdimension'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segmentation',
+            name='evaluated_analytics_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='segmentation',
+            name='evaluated_rql_query',
+            field=models.CharField(blank=True, max_length=1000, null=True),
+        ),
+        migrations.AddField(
+            model_name='segmentation',
+            name='rebuilt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.1 on 2026-10-18 14:48
+
+import app.managers
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_segmentation_evaluation_state'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='visitorsegmentationmap',
+            managers=[
+                ('objects', app.managers.VisitorSegmentationMapManager()),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1 on 2026-10-18 14:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0022_alter_visitorsegmentationmap_managers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsExport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rql_query', models.CharField(blank=True, default='', max_length=1000)),
+                ('file_format', models.CharField(choices=[('ndjson', 'NDJSON'), ('csv', 'CSV')], default='ndjson', max_length=8)),
+                ('compress', models.BooleanField(default=False)),
+                ('state', models.CharField(choices=[('P', 'Pending'), ('R', 'Running'), ('C', 'Completed'), ('F', 'Failed')], default='P', max_length=2)),
+                ('file', models.FileField(blank=True, null=True, upload_to='exports/analytics/')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='analytics_exports', to='app.account')),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.1 on 2026-10-18 14:56
+
+import app.managers
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_analyticsexport'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='message',
+            managers=[
+                ('objects', app.managers.MessageManager()),
+            ],
+        ),
+    ]
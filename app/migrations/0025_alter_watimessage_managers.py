@@ -0,0 +1,20 @@
+# Generated by Django 4.1 on 2026-10-18 14:59
+
+import app.managers
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0024_alter_message_managers'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='watimessage',
+            managers=[
+                ('objects', app.managers.WatiMessageManager()),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1 on 2026-10-18 15:01
+
+import app.managers
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0025_alter_watimessage_managers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageAudienceBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('visitor_ids', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='audience_batches', to='app.message')),
+            ],
+            managers=[
+                ('objects', app.managers.MessageAudienceBatchManager()),
+            ],
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.1 on 2026-10-18 15:04
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0026_messageaudiencebatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageaudiencebatch',
+            name='dispatched_at',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='messageaudiencebatch',
+            name='send_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='messageaudiencebatch',
+            name='state',
+            field=models.CharField(choices=[('S', 'Scheduled'), ('D', 'Dispatched'), ('C', 'Completed')], default='S', max_length=1),
+        ),
+        # Existing batches were queued with an eta when created, their tasks send
+        # them. Without a dispatch time they are never dispatched again.
+        migrations.RunSQL(
+            "UPDATE app_messageaudiencebatch SET state = 'D'",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='messageaudiencebatch',
+            index=models.Index(condition=models.Q(('state', 'S')), fields=['send_at'], name='audience_batch_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messageaudiencebatch',
+            index=models.Index(condition=models.Q(('state', 'D')), fields=['dispatched_at'], name='audience_batch_dispatched_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1 on 2026-10-18 15:14
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0027_messageaudiencebatch_schedule'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='analytics',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
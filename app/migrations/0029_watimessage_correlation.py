@@ -0,0 +1,29 @@
+# Generated by Django 4.1 on 2026-10-18 15:21
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0028_analytics_created_received'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watimessage',
+            name='correlation_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='watimessage',
+            name='correlation_failed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='watimessage',
+            name='sent_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1 on 2026-10-18 15:24
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0029_watimessage_correlation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageaudiencebatch',
+            name='uncertain_visitor_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), default=list, size=None),
+        ),
+    ]
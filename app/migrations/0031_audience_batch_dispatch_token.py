@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0030_audience_batch_uncertain_visitors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageaudiencebatch',
+            name='dispatch_token',
+            field=models.UUIDField(default=None, null=True),
+        ),
+    ]
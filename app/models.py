@@ -1,5 +1,8 @@
+from django.contrib.postgres.fields import ArrayField
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import AbstractUser
+from django.utils.timezone import now
 
 from . import managers
 
@@ -41,18 +44,149 @@ class Analytics(models.Model):
     timezone = models.CharField(max_length=64, null=True, blank=True)
     time_stayed = models.FloatField(null=True, blank=True)
 
-    created = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, buffered events are written with the time they were received
+    created = models.DateTimeField(default=now, editable=False)
 
-    account = models.ForeignKey(Account, related_name='analytics', on_delete=models.CASCADE)
+    # Every index below leads with account, so the plain FK index is not needed.
+    account = models.ForeignKey(Account, related_name='analytics', on_delete=models.CASCADE, db_index=False)
     visitor = models.ForeignKey('Visitor', related_name='analytics', on_delete=models.CASCADE)
 
     objects = managers.AnalyticsManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['account', 'created'], name='analytics_account_created_idx'),
+            models.Index(fields=['account', 'page_name'], name='analytics_account_page_idx'),
+            models.Index(fields=['account', 'button_clicked'], name='analytics_account_button_idx',
+                         condition=~Q(button_clicked='')),
+            models.Index(fields=['account', 'visitor'], name='analytics_account_visitor_idx'),
+        ]
+
+
+class AnalyticsRollup(models.Model):
+    """
+    Event counts per account, time bucket and dimension values, maintained
+    incrementally from `Analytics` by `AnalyticsRollupService`.
+    Missing dimension values are stored as an empty string.
+    """
+    HOURLY = 'hour'
+    DAILY = 'day'
+    GRANULARITY_CHOICES = (
+        (HOURLY, 'Hourly'),
+        (DAILY, 'Daily')
+    )
+
+    granularity = models.CharField(max_length=8, choices=GRANULARITY_CHOICES)
+    bucket = models.DateTimeField()
+
+    page_name = models.CharField(max_length=128, default='', blank=True)
+    button_clicked = models.CharField(max_length=128, default='', blank=True)
+    device = models.CharField(max_length=64, default='', blank=True)
+    browser = models.CharField(max_length=64, default='', blank=True)
+
+    count = models.BigIntegerField(default=0)
+
+    # Covered by the unique constraint, which leads with account.
+    account = models.ForeignKey(Account, related_name='analytics_rollups', on_delete=models.CASCADE, db_index=False)
+
+    objects = managers.AnalyticsRollupManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['account', 'granularity', 'bucket', 'page_name', 'button_clicked', 'device', 'browser'],
+                name='analytics_rollup_unique'
+            ),
+        ]
+
+
+class AnalyticsDimension(models.Model):
+    """
+    Distinct values of an analytics dimension per account with when they
+    were first and last seen and how often. Maintained by the rollup job.
+    """
+    PAGE_NAME = 'page_name'
+    BUTTON_CLICKED = 'button_clicked'
+    DIMENSION_CHOICES = (
+        (PAGE_NAME, 'Page name'),
+        (BUTTON_CLICKED, 'Button clicked')
+    )
+
+    dimension = models.CharField(max_length=32, choices=DIMENSION_CHOICES)
+    value = models.CharField(max_length=128)
+
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField()
+    hit_count = models.BigIntegerField(default=0)
+
+    # Covered by the unique constraint, which leads with account.
+    account = models.ForeignKey(Account, related_name='analytics_dimensions', on_delete=models.CASCADE, db_index=False)
+
+    objects = managers.AnalyticsDimensionManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'dimension', 'value'], name='analytics_dimension_unique'),
+        ]
+
+
+class AnalyticsExport(models.Model):
+    """
+    Export of an account's analytics matching an RQL query, written to a
+    file in the background by the `export_analytics` task.
+    """
+    NDJSON = 'ndjson'
+    CSV = 'csv'
+    FORMAT_CHOICES = (
+        (NDJSON, 'NDJSON'),
+        (CSV, 'CSV')
+    )
+
+    PENDING_STATE = 'P'
+    RUNNING_STATE = 'R'
+    COMPLETED_STATE = 'C'
+    FAILED_STATE = 'F'
+    STATE_CHOICES = (
+        (PENDING_STATE, 'Pending'),
+        (RUNNING_STATE, 'Running'),
+        (COMPLETED_STATE, 'Completed'),
+        (FAILED_STATE, 'Failed')
+    )
+
+    rql_query = models.CharField(max_length=1000, blank=True, default='')
+    file_format = models.CharField(max_length=8, choices=FORMAT_CHOICES, default=NDJSON)
+    compress = models.BooleanField(default=False)
+
+    state = models.CharField(max_length=2, choices=STATE_CHOICES, default=PENDING_STATE)
+    file = models.FileField(upload_to='exports/analytics/', null=True, blank=True)
+
+    account = models.ForeignKey(Account, related_name='analytics_exports', on_delete=models.CASCADE)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class AnalyticsWatermark(models.Model):
+    """
+    Id of the last `Analytics` row processed by an incremental job.
+
+    The checkpoint and settled rows track the ids below which every row is
+    committed, see `AnalyticsManager.get_settled_max_id`.
+    """
+    ROLLUP = 'rollup'
+    CHECKPOINT = 'checkpoint'
+    SETTLED = 'settled'
+
+    name = models.CharField(max_length=64, unique=True)
+    last_analytics_id = models.BigIntegerField(default=0)
+
+    updated = models.DateTimeField(auto_now=True)
+
 
 class Visitor(models.Model):
     name = models.CharField(max_length=64, null=True, blank=True)
     whatsapp_number = models.CharField(max_length=32)
-    device_uuid = models.UUIDField()
+    device_uuid = models.UUIDField(unique=True)
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -61,6 +195,11 @@ class Visitor(models.Model):
 
     objects = managers.VisitorManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['whatsapp_number'], name='visitor_whatsapp_number_idx'),
+        ]
+
 
 class Segmentation(models.Model):
     name = models.CharField(max_length=64)
@@ -71,6 +210,11 @@ class Segmentation(models.Model):
 
     account = models.ForeignKey(Account, related_name='segmentations', on_delete=models.CASCADE)
 
+    # State of the last evaluation, used to evaluate additive queries incrementally.
+    evaluated_rql_query = models.CharField(max_length=1000, null=True, blank=True)
+    evaluated_analytics_id = models.BigIntegerField(default=0)
+    rebuilt_at = models.DateTimeField(null=True, blank=True)
+
     objects = managers.SegmentationManager()
 
     def get_campaigns(self):
@@ -82,7 +226,9 @@ class VisitorSegmentationMap(models.Model):
     segmentation = models.ForeignKey(Segmentation, on_delete=models.CASCADE)
 
     created = models.DateTimeField(auto_now_add=True)
-    
+
+    objects = managers.VisitorSegmentationMapManager()
+
     class Meta:
         unique_together = ('visitor', 'segmentation')
 
@@ -112,13 +258,77 @@ class WatiTemplate(models.Model):
     objects = managers.WatiTemplateManager()
 
 
+class MessageAudienceBatch(models.Model):
+    """
+    Visitors a message is sent to by one `schedule_message` task, so the task
+    only carries the batch id. `sent` counts the visitors already sent to and
+    is updated after every chunk, a retried send resumes from there. Chunks
+    whose send failed after it may have reached Wati are not sent again, their
+    visitors are kept in `uncertain_visitor_ids` to be checked instead.
+
+    Batches are also the timers of delayed messages: they wait in the
+    scheduled state until `send_at`, when `dispatch_due_messages` claims them
+    and queues their `schedule_message` task with a new `dispatch_token`.
+    The task only writes to the batch while it still holds that token, and
+    touches `updated` after every chunk, so a batch is only dispatched again
+    once its task stopped making progress, and a superseded task stops.
+    """
+    SCHEDULED_STATE = 'S'
+    DISPATCHED_STATE = 'D'
+    COMPLETED_STATE = 'C'
+
+    STATE_CHOICES = (
+        (SCHEDULED_STATE, 'Scheduled'),
+        (DISPATCHED_STATE, 'Dispatched'),
+        (COMPLETED_STATE, 'Completed'),
+    )
+
+    visitor_ids = ArrayField(models.BigIntegerField())
+    sent = models.PositiveIntegerField(default=0)
+    uncertain_visitor_ids = ArrayField(models.BigIntegerField(), default=list)
+    state = models.CharField(max_length=1, choices=STATE_CHOICES, default=SCHEDULED_STATE)
+    send_at = models.DateTimeField(default=now)
+    dispatched_at = models.DateTimeField(null=True, default=None)
+    dispatch_token = models.UUIDField(null=True, default=None)
+
+    message = models.ForeignKey('Message', related_name='audience_batches', on_delete=models.CASCADE)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = managers.MessageAudienceBatchManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['send_at'], name='audience_batch_due_idx',
+                         condition=Q(state='S')),
+            models.Index(fields=['dispatched_at'], name='audience_batch_dispatched_idx',
+                         condition=Q(state='D')),
+        ]
+
+
 class WatiMessage(models.Model):
+    """
+    A message sent to a visitor. Its Wati id is looked up after sending by
+    `correlate_wati_messages`, which gives up after a number of attempts.
+    """
     wati_message_id = models.CharField(max_length=128, null=True, default=None)
+    sent_at = models.DateTimeField(default=now)
+    correlation_attempts = models.PositiveSmallIntegerField(default=0)
+    correlation_failed = models.BooleanField(default=False)
 
     message = models.ForeignKey('Message', related_name='wati_messages', on_delete=models.CASCADE)
 
     visitor = models.ForeignKey(Visitor, related_name='wati_messages', on_delete=models.CASCADE)
 
+    objects = managers.WatiMessageManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['wati_message_id'], name='watimessage_wati_id_idx',
+                         condition=Q(wati_message_id__isnull=False)),
+        ]
+
 
 class Campaign(models.Model):
 
@@ -164,29 +374,22 @@ class Message(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = managers.MessageManager()
+
     class Meta:
         unique_together = ('parent', 'action',)
 
+    def get_message_tree(self):
+        return Message.objects.get_message_tree_for_campaign(self.campaign_id)
+
     def get_head_message(self):
-        head = self
-        parent = self.parent
-        while parent is not None:
-            head = parent
-            parent = parent.parent
-        return head
+        return self.get_message_tree().get_head_message(self)
 
     def get_descendants(self):
-        descendants = Message.objects.filter(parent=self)
-        return descendants
+        return self.get_message_tree().get_children(self)
 
     def get_descendants_for_action_performed(self, action: int):
-        descendants = Message.objects.filter(parent=self, action=action)
-        return descendants
+        return self.get_message_tree().get_children(self, action=action)
 
     def get_ancestors(self):
-        ancestors = []
-        parent = self.parent
-        while parent is not None:
-            ancestors.append(parent)
-            parent = parent.parent
-        return ancestors
+        return self.get_message_tree().get_ancestors(self)
@@ -0,0 +1,192 @@
+import binascii
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.db import connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+def get_estimated_count(queryset):
+    """
+    Number of rows of `queryset` as estimated by the query planner,
+    the query itself is not run.
+    """
+    plan = json.loads(queryset.explain(format='json'))
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def get_pagination_query_params(paginator, request):
+    """
+    Names of the query parameters `paginator` reads from `request`.
+    """
+    if hasattr(paginator, 'get_query_params'):
+        return paginator.get_query_params(request)
+    names = ('page_query_param', 'page_size_query_param', 'limit_query_param', 'offset_query_param',
+             'cursor_query_param')
+    return {getattr(paginator, name) for name in names if getattr(paginator, name, None)}
+
+
+class CreatedCursorPagination(BasePagination):
+    """
+    Keyset pagination over `(created, id)`, newest first. Pages start after
+    the `(created, id)` of the last row of the previous page, compared as a
+    row, so they are as fast deep into the listing as on the first page and
+    rows sharing `created` are neither skipped nor repeated. No total count
+    is run, `?count=estimate` adds the planner's estimate of it.
+
+    Cursors are unpadded urlsafe base64, so they never contain `=` and do
+    not interfere with RQL parsing of the query string.
+    """
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'limit'
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+    display_page_controls = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.estimated_count = None
+        if request.query_params.get(self.count_query_param, '').lower() == 'estimate':
+            self.estimated_count = get_estimated_count(queryset)
+
+        position = self.decode_cursor(request)
+        reverse = bool(position and position[2])
+
+        table = connections[queryset.db].ops.quote_name(queryset.model._meta.db_table)
+        if position is not None:
+            created, pk, _ = position
+            operator = '>' if reverse else '<'
+            queryset = queryset.filter(RawSQL(f'({table}."created", {table}."id") {operator} (%s, %s)',
+                                              [created, pk], output_field=BooleanField()))
+        ordering = ('created', 'id') if reverse else ('-created', '-id')
+        results = list(queryset.order_by(*ordering)[:self.page_size + 1])
+
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_previous, self.has_next = has_more, position is not None
+        else:
+            self.has_previous, self.has_next = position is not None, has_more
+
+        self.page = results
+        return results
+
+    def get_query_params(self, request):
+        return {self.cursor_query_param, self.count_query_param, self.page_size_query_param}
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def decode_cursor(self, request):
+        """
+        `(created, id, reverse)` of the request's cursor, None without one.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            decoded = b64decode((encoded + '=' * (-len(encoded) % 4)).encode(), altchars=b'-_').decode()
+            created, pk, reverse = decoded.split('|')
+            created = parse_datetime(created)
+            if created is None:
+                raise ValueError
+            return created, int(pk), reverse == '1'
+        except (TypeError, ValueError, UnicodeDecodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, instance, reverse):
+        cursor = f'{instance.created.isoformat()}|{instance.pk}|{int(reverse)}'
+        encoded = b64encode(cursor.encode(), altchars=b'-_').decode().rstrip('=')
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        response_data = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ])
+        if self.estimated_count is not None:
+            response_data['estimated_count'] = self.estimated_count
+        return Response(response_data)
+
+    def get_paginated_response_schema(self, schema):
+        return CursorPagination().get_paginated_response_schema(schema)
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+        ]
+
+
+class LimitOffsetOrCursorPagination(BasePagination):
+    """
+    `LimitOffsetPagination` unless the client opts in to cursor pagination
+    with `?pagination=cursor`, or follows a link of a cursor page.
+    RQL ordering is ignored in cursor mode.
+    """
+    limit_offset_pagination_class = LimitOffsetPagination
+    cursor_pagination_class = CreatedCursorPagination
+    pagination_query_param = 'pagination'
+
+    def get_paginator(self, request):
+        if (request.query_params.get(self.pagination_query_param, '').lower() == 'cursor' or
+                self.cursor_pagination_class.cursor_query_param in request.query_params):
+            return self.cursor_pagination_class()
+        return self.limit_offset_pagination_class()
+
+    def get_query_params(self, request):
+        return {self.pagination_query_param} | get_pagination_query_params(self.get_paginator(request), request)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.paginator = self.get_paginator(request)
+        page = self.paginator.paginate_queryset(queryset, request, view=view)
+        self.display_page_controls = self.paginator.display_page_controls
+        return page
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return self.limit_offset_pagination_class().get_paginated_response_schema(schema)
+
+    def get_schema_operation_parameters(self, view):
+        return (self.limit_offset_pagination_class().get_schema_operation_parameters(view) +
+                self.cursor_pagination_class().get_schema_operation_parameters(view))
+
+    def to_html(self):
+        return self.paginator.to_html()
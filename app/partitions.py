@@ -0,0 +1,118 @@
+import logging
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from app.models import Analytics
+
+
+logger = logging.getLogger(__name__)
+
+PARTITION_NAME = '{table}_p{year:04d}_{month:02d}'
+PARTITION_NAME_PATTERN = re.compile(r'_p(?P<year>\d{4})_(?P<month>\d{2})$')
+
+
+def _add_months(month_start, months):
+    month_index = month_start.year * 12 + month_start.month - 1 + months
+    return month_start.replace(year=month_index // 12, month=month_index % 12 + 1)
+
+
+def _month_start(value):
+    value = value.astimezone(dt_timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def get_analytics_partitions():
+    """
+    Return `{partition_name: month_start}` for the monthly partitions of
+    the analytics table. The default partition is not included.
+    """
+    table = Analytics._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass',
+            [table]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    partitions = {}
+    for name in names:
+        match = PARTITION_NAME_PATTERN.search(name)
+        if match:
+            partitions[name] = datetime(int(match['year']), int(match['month']), 1, tzinfo=dt_timezone.utc)
+    return partitions
+
+
+def create_analytics_partition(month_start):
+    """
+    Create the partition holding the month starting at `month_start`.
+    Rows for that month that already landed in the default partition are
+    moved into the new partition.
+    """
+    table = Analytics._meta.db_table
+    name = PARTITION_NAME.format(table=table, year=month_start.year, month=month_start.month)
+    month_end = _add_months(month_start, 1)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {table}_default')
+        cursor.execute(
+            f'CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)',
+            [month_start, month_end]
+        )
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {table}_default WHERE created >= %s AND created < %s RETURNING *) '
+            f'INSERT INTO {table} SELECT * FROM moved',
+            [month_start, month_end]
+        )
+        cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {table}_default DEFAULT')
+    return name
+
+
+def remove_analytics_partition(name, drop=False):
+    table = Analytics._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {name}')
+        if drop:
+            cursor.execute(f'DROP TABLE {name}')
+
+
+def maintain_analytics_partitions(months_ahead=None, retention_months=None, drop=None):
+    """
+    Create the monthly partitions up to `months_ahead` months from now and
+    detach (or drop, if `drop` is set) the ones entirely older than
+    `retention_months`. A retention of 0 keeps every partition.
+    Defaults come from the `ANALYTICS_PARTITION_*` settings.
+    Returns the names of the created and removed partitions.
+    """
+    if months_ahead is None:
+        months_ahead = settings.ANALYTICS_PARTITION_MONTHS_AHEAD
+    if retention_months is None:
+        retention_months = settings.ANALYTICS_PARTITION_RETENTION_MONTHS
+    if drop is None:
+        drop = settings.ANALYTICS_PARTITION_DROP_EXPIRED
+
+    partitions = get_analytics_partitions()
+    existing_months = set(partitions.values())
+    current_month = _month_start(timezone.now())
+
+    created = []
+    for months in range(months_ahead + 1):
+        month_start = _add_months(current_month, months)
+        if month_start not in existing_months:
+            created.append(create_analytics_partition(month_start))
+            logger.info(f'Created analytics partition {created[-1]}')
+
+    removed = []
+    if retention_months:
+        oldest_kept = _add_months(current_month, -retention_months)
+        for name, month_start in sorted(partitions.items(), key=lambda item: item[1]):
+            if month_start < oldest_kept:
+                remove_analytics_partition(name, drop=drop)
+                removed.append(name)
+                logger.info(f'{"Dropped" if drop else "Detached"} analytics partition {name}')
+
+    return created, removed
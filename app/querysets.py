@@ -10,3 +10,13 @@ class VisitorQuerySet(models.QuerySet):
         return self.for_account(account).prefetch_related(
             models.Prefetch('analytics', queryset=Analytics.objects.filter(account=account))
         )
+
+    def with_account_membership(self, account):
+        """
+        Annotate `in_account`, whether the visitor belongs to `account`,
+        so serializing a page of visitors does not query it per row.
+        """
+        from app.models import Visitor
+        return self.annotate(in_account=models.Exists(
+            Visitor.account.through.objects.filter(visitor=models.OuterRef('pk'), account=account)
+        ))
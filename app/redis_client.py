@@ -0,0 +1,16 @@
+import redis
+from django.conf import settings
+
+
+_connection = None
+
+def get_redis_connection():
+    """
+    Return a process wide redis client for `settings.REDIS_URL`.
+    The client keeps its own connection pool, so it is created only once
+    per process and shared by every caller.
+    """
+    global _connection
+    if _connection is None:
+        _connection = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _connection
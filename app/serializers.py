@@ -1,13 +1,15 @@
+from datetime import timedelta
 from urllib.parse import urlparse
 
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from rest_framework import serializers
-from py_rql.parser import RQLParser
 
 from app import custom_exceptions
+from app.filters import AnalyticsFilters
 from app.tenant import get_current_account
 
-from .models import (Account, Visitor, Analytics,
+from .models import (Account, Visitor, Analytics, AnalyticsRollup, AnalyticsExport,
                      Segmentation, WatiAttribute,
                      WatiTemplate, Campaign, Message,
                      VisitorSegmentationMap)
@@ -54,6 +56,8 @@ class VisitorSerializer(serializers.ModelSerializer):
     class Meta:
         model = Visitor
         fields = '__all__'
+        # Represented as the current account only, see `to_representation`
+        extra_kwargs = {'account': {'write_only': True}}
 
     def create(self, validated_data):
         visitor = Visitor.objects.create_visitor(**validated_data)
@@ -62,13 +66,28 @@ class VisitorSerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         data = super().to_representation(instance)
         account = get_current_account()
-        if Visitor.objects.is_visitor_in_account(visitor=instance, account=account):
+        # Annotated by the account scoped querysets, see `VisitorQuerySet.with_account_membership`
+        in_account = getattr(instance, 'in_account', None)
+        if in_account is None:
+            in_account = Visitor.objects.is_visitor_in_account(visitor=instance, account=account)
+        if in_account:
             data['account'] = account.id
-        else:
-            del data['account']
         return data
 
 
+class VisitorReportSerializer(serializers.ModelSerializer):
+    """
+    Validates a reported visitor. `device_uuid` is not checked for uniqueness
+    since reporting an existing device adds it to the current account.
+    """
+    class Meta:
+        model = Visitor
+        fields = ('name', 'whatsapp_number', 'device_uuid')
+        extra_kwargs = {
+            'device_uuid': {'validators': []}
+        }
+
+
 class AnalyticsSerializer(serializers.ModelSerializer):
     class Meta:
         model = Analytics
@@ -86,6 +105,42 @@ class AnalyticsSerializer(serializers.ModelSerializer):
         return analytics
 
 
+class AnalyticsIngestionSerializer(serializers.ModelSerializer):
+    """
+    Validates a single ingested event without touching the database.
+    The visitor and account are resolved by the caller from `device_uuid`
+    and the current account.
+    """
+    device_uuid = serializers.UUIDField(write_only=True)
+
+    class Meta:
+        model = Analytics
+        exclude = ('account', 'visitor')
+
+
+class AnalyticsTimeseriesQuerySerializer(serializers.Serializer):
+    """
+    Query parameters of the analytics time-series endpoint.
+    Defaults to the last 7 days when `start` or `end` are not given.
+    """
+    granularity = serializers.ChoiceField(choices=AnalyticsRollup.GRANULARITY_CHOICES,
+                                          default=AnalyticsRollup.HOURLY)
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+    page_name = serializers.CharField(required=False, allow_blank=True)
+    button_clicked = serializers.CharField(required=False, allow_blank=True)
+    device = serializers.CharField(required=False, allow_blank=True)
+    browser = serializers.CharField(required=False, allow_blank=True)
+
+    def validate(self, attrs):
+        attrs.setdefault('end', timezone.now())
+        attrs.setdefault('start', attrs['end'] - timedelta(days=7))
+        if attrs['start'] >= attrs['end']:
+            raise serializers.ValidationError({'start': 'start must be before end.'})
+        return attrs
+
+
 class VisitorWithAnalyticsSerializer(VisitorSerializer):
     analytics = AnalyticsSerializer(many=True, read_only=True)
 
@@ -94,18 +149,35 @@ class AnalyticsWithVisitorSerializer(AnalyticsSerializer):
     visitor = VisitorSerializer(read_only=True)
 
 
+class AnalyticsExportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AnalyticsExport
+        fields = '__all__'
+        read_only_fields = ('state', 'file')
+
+    def validate_rql_query(self, value):
+        if value:
+            AnalyticsFilters.compile_query(value)
+        return value
+
+
 class SegmentationSerializer(serializers.ModelSerializer):
     visitor_count = serializers.SerializerMethodField()
     class Meta:
         model = Segmentation
         fields = '__all__'
+        read_only_fields = ('evaluated_rql_query', 'evaluated_analytics_id', 'rebuilt_at')
 
     def get_visitor_count(self, instance):
+        # Annotated by the viewset queryset, counted only for freshly created segmentations
+        if hasattr(instance, 'visitor_count'):
+            return instance.visitor_count
         count = VisitorSegmentationMap.objects.filter(segmentation=instance).count()
         return count
 
     def validate_rql_query(self, value):
-        RQLParser.parse_query(value)
+        # Compiling also warms the cache used when the segment is evaluated
+        AnalyticsFilters.compile_query(value)
         # Exception is handled by custom exception handler
         return value
 
@@ -1,20 +1,38 @@
+import logging
+import tempfile
 from datetime import timedelta
 from django.utils import timezone
 
+import redis
+import requests
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import transaction
+from django.core.files import File
+from django.db import IntegrityError, transaction
 
+from app import exports
 from app.tenant import get_current_account
-from app.custom_exceptions import VisitorAlreadyReported, VisitorNotReported, WatiConnectionError
-from app.wati import Wati
-
-from .serializers import (AccountSerializer, UserSerializer, VisitorSerializer,
-                          AnalyticsSerializer, SegmentationSerializer, WatiAttributeSerializer,
-                          CampaignSerializer, MessageSerializer)
-from .models import Analytics, Visitor, Message, WatiAttribute, WatiTemplate, WatiMessage, VisitorSegmentationMap
+from app.custom_exceptions import (VisitorAlreadyReported, VisitorNotReported, WatiConnectionError,
+                                   InvalidAnalyticsBatch, InvalidVisitorBatch)
+from app.caches import get_visitor_resolution_cache, get_visitor_name_miss_cache
+from app.filters import AnalyticsFilters
+from app.ingestion_buffer import AnalyticsIngestionBuffer
+from app.throttling import TokenBucket
+from app.wati import (AsyncWati, Wati, WatiRequestNotSent, find_sent_template_message_id, run_async,
+                      was_request_received)
+
+from .serializers import (AccountSerializer, UserSerializer, VisitorReportSerializer,
+                          AnalyticsIngestionSerializer, AnalyticsExportSerializer, SegmentationSerializer,
+                          WatiAttributeSerializer, CampaignSerializer, MessageSerializer)
+from .models import (Account, Analytics, AnalyticsRollup, AnalyticsDimension, AnalyticsWatermark, AnalyticsExport,
+                     Visitor, Segmentation, Message, MessageAudienceBatch, WatiAttribute, WatiTemplate, WatiMessage,
+                     VisitorSegmentationMap)
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
+
 class AccountRegistrationService:
     @classmethod
     @transaction.atomic
@@ -41,23 +59,58 @@ class AccountRegistrationService:
 class VisitorService:
     @classmethod
     def report_visitor(cls, visitor_data):
+        """
+        Report a visitor for the current account and return it. The visitor is
+        created if its device is new, then added to the account. Safe under
+        concurrent reports for the same device since both steps are single upserts.
+        """
         account = get_current_account()
-        visitor_data['account'] = [account.id]
-        visitor_serializer = VisitorSerializer(data=visitor_data)
+        visitor_serializer = VisitorReportSerializer(data=visitor_data)
         visitor_serializer.is_valid(raise_exception=True)
 
         device_uuid = visitor_serializer.validated_data.get('device_uuid')
 
-        try:
-            visitor = Visitor.objects.prefetch_related('account').get(device_uuid=device_uuid)
-            if not Visitor.objects.is_visitor_in_account(visitor, account):
-                Visitor.objects.add_visitor_to_current_account(visitor=visitor)
-            else:
-                raise VisitorAlreadyReported
-        except Visitor.DoesNotExist:
-            visitor = visitor_serializer.save(account=account)
+        with transaction.atomic():
+            visitor_ids = Visitor.objects.upsert_visitors([visitor_serializer.validated_data])
+            added_visitor_ids = Visitor.objects.add_visitors_to_account(visitor_ids.values(), account)
 
-        return visitor
+        get_visitor_resolution_cache().set_many(account.id, visitor_ids)
+
+        if not added_visitor_ids:
+            raise VisitorAlreadyReported
+
+        return Visitor.objects.get(id=visitor_ids[device_uuid])
+
+    @classmethod
+    def report_visitors(cls, visitors_data):
+        """
+        Report many visitors for the current account with one upsert for the
+        visitors and one for their account membership. Invalid entries are
+        returned as `(index, detail)` pairs instead of failing the batch.
+        """
+        if not isinstance(visitors_data, list) or not visitors_data:
+            raise InvalidVisitorBatch
+        max_size = settings.VISITOR_REPORT_BATCH_MAX_SIZE
+        if len(visitors_data) > max_size:
+            raise InvalidVisitorBatch(detail=f'Visitor batch can not have more than {max_size} visitors.')
+
+        account = get_current_account()
+        errors = []
+        validated_visitors = []
+        for index, visitor_data in enumerate(visitors_data):
+            visitor_serializer = VisitorReportSerializer(data=visitor_data)
+            if not visitor_serializer.is_valid():
+                errors.append({'index': index, 'detail': visitor_serializer.errors})
+                continue
+            validated_visitors.append(visitor_serializer.validated_data)
+
+        with transaction.atomic():
+            visitor_ids = Visitor.objects.upsert_visitors(validated_visitors)
+            added_visitor_ids = Visitor.objects.add_visitors_to_account(visitor_ids.values(), account)
+
+        get_visitor_resolution_cache().set_many(account.id, visitor_ids)
+
+        return len(added_visitor_ids), len(visitor_ids) - len(added_visitor_ids), errors
 
     @classmethod
     def update_visitor_name(cls, visitor, visitor_name):
@@ -68,34 +121,322 @@ class VisitorService:
     
     @classmethod
     def sync_name_for_visitors_for_account(cls, account):
-        visitors = Visitor.objects.get_visitors_without_name_for_account(account=account)
+        """
+        Fill in the names of the account's visitors without one from their Wati
+        contacts. Names are looked up concurrently and saved with one update.
+        Numbers without a name are not looked up again for `VISITOR_NAME_MISS_BACKOFF`
+        seconds. Returns the number of visitors named.
+        """
         wati_attribute = WatiAttribute.objects.get_wati_attribute_for_account(account=account)
+        if not wati_attribute.connected:
+            return 0
+
+        visitors = list(Visitor.objects.get_visitors_without_name_for_account(account=account)
+                        .only('id', 'name', 'whatsapp_number'))
+        miss_cache = get_visitor_name_miss_cache()
+        whatsapp_numbers = list({visitor.whatsapp_number for visitor in visitors})
+        whatsapp_numbers = list(set(whatsapp_numbers) - miss_cache.get_misses(account.id, whatsapp_numbers))
+        if not whatsapp_numbers:
+            return 0
+
         wati = Wati(**wati_attribute.get_api_credentials())
+        names = run_async(AsyncWati(wati).get_names_for_numbers(whatsapp_numbers))
+
+        misses = []
+        for whatsapp_number, name in names.items():
+            if isinstance(name, Exception):
+                logger.warning(f'Could not get the name of number {whatsapp_number} of account {account.id}: {name}')
+            elif not name:
+                misses.append(whatsapp_number)
+        miss_cache.add_misses(account.id, misses)
+
+        named_visitors = []
         for visitor in visitors:
-            name = wati.get_name_for_number(whatsapp_number=visitor.whatsapp_number)
-            if name:
-                VisitorService.update_visitor_name(visitor, name)
+            name = names.get(visitor.whatsapp_number)
+            if name and not isinstance(name, Exception):
+                visitor.name = name
+                named_visitors.append(visitor)
+        Visitor.objects.bulk_update(named_visitors, ['name'])
+        return len(named_visitors)
 
 
 class AnalyticsService:
     @classmethod
     def ingest_analytics(cls, analytics_data):
-        device_uuid = analytics_data.get('device_uuid')
-        try:
-            visitor = Visitor.objects.get(device_uuid=device_uuid)
-        except Visitor.DoesNotExist:
+        account = get_current_account()
+
+        analytics_serializer = AnalyticsIngestionSerializer(data=analytics_data)
+        analytics_serializer.is_valid(raise_exception=True)
+
+        analytics, errors = AnalyticsService.write_analytics_for_account(
+            account, [(0, analytics_serializer.validated_data)]
+        )
+        if errors:
             raise VisitorNotReported
+
+        return analytics[0]
+
+    @classmethod
+    def ingest_analytics_batch(cls, events):
+        """
+        Ingest a list of events for the current account.
+
+        Visitors for all events are resolved (and checked against the account)
+        in a single query and the valid events are written with one bulk insert.
+        Invalid events do not fail the batch, they are reported back as
+        `(index, detail)` pairs instead.
+        """
         account = get_current_account()
 
-        analytics_data['visitor'] = visitor.id
-        analytics_data['account'] = account.id
+        validated_events, errors = AnalyticsService.validate_analytics_batch(events)
+        analytics, resolve_errors = AnalyticsService.write_analytics_for_account(account, validated_events)
+
+        return analytics, errors + resolve_errors
 
-        analytics_serializer = AnalyticsSerializer(data=analytics_data)
+    @classmethod
+    def validate_analytics_batch(cls, events):
+        if not isinstance(events, list) or not events:
+            raise InvalidAnalyticsBatch
+        max_size = settings.ANALYTICS_INGEST_BATCH_MAX_SIZE
+        if len(events) > max_size:
+            raise InvalidAnalyticsBatch(detail=f'Analytics batch can not have more than {max_size} events.')
+
+        errors = []
+        validated_events = []
+        for index, event in enumerate(events):
+            analytics_serializer = AnalyticsIngestionSerializer(data=event)
+            if not analytics_serializer.is_valid():
+                errors.append({'index': index, 'detail': analytics_serializer.errors})
+                continue
+            validated_events.append((index, analytics_serializer.validated_data))
+
+        return validated_events, errors
+
+    @classmethod
+    def write_analytics_for_account(cls, account, validated_events):
+        """
+        Build the `Analytics` of `(index, validated_data)` pairs and write them
+        with one bulk insert. A visitor deleted since it was cached fails the
+        insert, the visitors are then resolved from the database and the insert
+        retried once. Returns the analytics written and the events' errors.
+        """
+        analytics_objs, errors = AnalyticsService.build_analytics_for_account(account, validated_events)
+        try:
+            with transaction.atomic():
+                return Analytics.objects.ingest_analytics_bulk(analytics_objs), errors
+        except IntegrityError as exc:
+            logger.warning(f'Analytics insert for account {account.id} failed, resolving visitors again: {exc}')
+
+        analytics_objs, errors = AnalyticsService.build_analytics_for_account(account, validated_events,
+                                                                              use_cache=False)
+        return Analytics.objects.ingest_analytics_bulk(analytics_objs), errors
+
+    @classmethod
+    def build_analytics_for_account(cls, account, validated_events, use_cache=True):
+        """
+        Build unsaved `Analytics` objects for `(index, validated_data)` pairs,
+        resolving every `device_uuid` against the account.
+        """
+        visitor_ids = AnalyticsService.resolve_visitor_ids(
+            account, {validated_data['device_uuid'] for _, validated_data in validated_events},
+            use_cache=use_cache
+        )
+
+        errors = []
+        analytics_objs = []
+        for index, validated_data in validated_events:
+            validated_data = dict(validated_data)
+            visitor_id = visitor_ids.get(validated_data.pop('device_uuid'))
+            if visitor_id is None:
+                errors.append({'index': index, 'detail': VisitorNotReported.default_detail})
+                continue
+            analytics_objs.append(Analytics(account=account, visitor_id=visitor_id, **validated_data))
+
+        return analytics_objs, errors
+
+    @classmethod
+    def resolve_visitor_ids(cls, account, device_uuids, use_cache=True):
+        """
+        Map device uuids to ids of visitors reported for the account. Cached
+        devices need no query, the rest are resolved together in one query.
+        Without `use_cache` all of them are resolved, and the devices no longer
+        resolving are invalidated.
+        """
+        cache = get_visitor_resolution_cache()
+        generation = cache.get_generation(account.id)
+        visitor_ids = cache.get_many(account.id, device_uuids, generation=generation) if use_cache else {}
+
+        missing = [device_uuid for device_uuid in device_uuids if device_uuid not in visitor_ids]
+        if missing:
+            resolved = Visitor.objects.get_visitor_ids_for_devices_in_account(device_uuids=missing,
+                                                                              account=account)
+            if not use_cache:
+                cache.invalidate_many(account.id, [device_uuid for device_uuid in missing
+                                                   if device_uuid not in resolved])
+                generation = None
+            cache.set_many(account.id, resolved, generation=generation)
+            visitor_ids.update(resolved)
+
+        return visitor_ids
+
+    @classmethod
+    def can_buffer_analytics(cls):
+        """
+        Whether events for the current account should go through the
+        write-behind buffer. Falls back to synchronous ingestion when the
+        buffer is disabled, unreachable or the account's stream is full.
+        """
+        if not settings.ANALYTICS_INGEST_WRITE_BEHIND:
+            return False
+        account = get_current_account()
+        try:
+            length = AnalyticsIngestionBuffer().length(account.id)
+        except redis.RedisError:
+            return False
+        return length < settings.ANALYTICS_INGEST_BUFFER_MAX_LENGTH
+
+    @classmethod
+    def buffer_analytics(cls, analytics_data):
+        account = get_current_account()
+
+        analytics_serializer = AnalyticsIngestionSerializer(data=analytics_data)
         analytics_serializer.is_valid(raise_exception=True)
 
-        analytics = analytics_serializer.save()
+        AnalyticsIngestionBuffer().append(account.id, [analytics_serializer.validated_data])
+
+    @classmethod
+    def buffer_analytics_batch(cls, events):
+        account = get_current_account()
+
+        validated_events, errors = AnalyticsService.validate_analytics_batch(events)
+        AnalyticsIngestionBuffer().append(account.id, [validated_data for _, validated_data in validated_events])
+
+        return len(validated_events), errors
 
-        return analytics
+    @classmethod
+    def drain_buffered_analytics(cls, account_id):
+        """
+        Flush the account's write-behind stream into `Analytics` with bulk
+        inserts. Entries are acknowledged only after their batch is written.
+        Returns the number of events written and the number dropped because
+        they were invalid or their visitor is not reported for the account.
+        """
+        buffer = AnalyticsIngestionBuffer()
+        try:
+            account = Account.objects.get(id=account_id)
+        except Account.DoesNotExist:
+            buffer.delete(account_id)
+            return 0, 0
+
+        ingested, dropped = 0, 0
+        for _ in range(settings.ANALYTICS_INGEST_DRAIN_MAX_BATCHES):
+            entries = buffer.read(account_id, count=settings.ANALYTICS_INGEST_DRAIN_BATCH_SIZE)
+            if not entries:
+                break
+
+            validated_events, errors = [], []
+            for index, (_, event, received) in enumerate(entries):
+                analytics_serializer = AnalyticsIngestionSerializer(data=event)
+                if not analytics_serializer.is_valid():
+                    errors.append({'index': index, 'detail': analytics_serializer.errors})
+                    continue
+                # Events keep the time they were received, not the time they are drained
+                validated_events.append((index, {**analytics_serializer.validated_data, 'created': received}))
+
+            analytics_objs, resolve_errors = AnalyticsService.write_analytics_for_account(account, validated_events)
+            buffer.ack(account_id, [entry_id for entry_id, _, _ in entries])
+
+            ingested += len(analytics_objs)
+            dropped += len(errors) + len(resolve_errors)
+
+        return ingested, dropped
+
+
+class AnalyticsRollupService:
+    @classmethod
+    def rollup_analytics(cls):
+        """
+        Fold the analytics rows created since the last run into the hourly and
+        daily rollups and the page name and button dimensions. Progress is
+        tracked by the id of the last processed row, and each chunk is rolled
+        up and its watermark moved in one transaction, so every row is counted
+        exactly once even across concurrent runs.
+
+        Rows after the settled id (see `get_settled_max_id`) are left for a
+        later run, giving in-flight inserts with lower ids time to commit.
+        """
+        watermark, _ = AnalyticsWatermark.objects.get_or_create(name=AnalyticsWatermark.ROLLUP)
+        to_id = Analytics.objects.get_settled_max_id(after_id=watermark.last_analytics_id)
+        if to_id is None:
+            return 0
+
+        rolled_up = 0
+        while True:
+            with transaction.atomic():
+                watermark = AnalyticsWatermark.objects.select_for_update().get(name=AnalyticsWatermark.ROLLUP)
+                from_id = watermark.last_analytics_id
+                if from_id >= to_id:
+                    break
+                chunk_to_id = min(from_id + settings.ANALYTICS_ROLLUP_BATCH_SIZE, to_id)
+
+                for granularity in (AnalyticsRollup.HOURLY, AnalyticsRollup.DAILY):
+                    AnalyticsRollup.objects.rollup_analytics_range(granularity, from_id, chunk_to_id)
+                for dimension in (AnalyticsDimension.PAGE_NAME, AnalyticsDimension.BUTTON_CLICKED):
+                    AnalyticsDimension.objects.update_dimension_range(dimension, from_id, chunk_to_id)
+
+                watermark.last_analytics_id = chunk_to_id
+                watermark.save()
+            rolled_up += chunk_to_id - from_id
+
+        return rolled_up
+
+
+class AnalyticsExportService:
+    @classmethod
+    def create(cls, data):
+        account = get_current_account()
+        data['account'] = account.id
+
+        analytics_export_serializer = AnalyticsExportSerializer(data=data)
+        analytics_export_serializer.is_valid(raise_exception=True)
+
+        analytics_export = analytics_export_serializer.save()
+
+        from app.tasks import export_analytics
+        export_analytics.delay(analytics_export.id)
+
+        return analytics_export
+
+    @classmethod
+    def run_export(cls, analytics_export):
+        """
+        Write the analytics matching the export's query to its file. Rows are
+        streamed to a temporary file first, so only complete files are stored.
+        """
+        analytics_export.state = AnalyticsExport.RUNNING_STATE
+        analytics_export.save(update_fields=['state', 'updated'])
+
+        try:
+            queryset = Analytics.objects.filter(account=analytics_export.account).order_by('id')
+            queryset = AnalyticsFilters.filter_queryset(queryset, analytics_export.rql_query)
+            chunks = exports.stream_analytics(queryset, analytics_export.file_format,
+                                              compress=analytics_export.compress)
+
+            with tempfile.TemporaryFile() as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                file.seek(0)
+                file_name = exports.get_export_file_name(f'analytics-{analytics_export.id}',
+                                                         analytics_export.file_format,
+                                                         compress=analytics_export.compress)
+                analytics_export.file.save(file_name, File(file), save=False)
+        except Exception:
+            analytics_export.state = AnalyticsExport.FAILED_STATE
+            analytics_export.save(update_fields=['state', 'updated'])
+            raise
+
+        analytics_export.state = AnalyticsExport.COMPLETED_STATE
+        analytics_export.save(update_fields=['state', 'file', 'updated'])
 
 
 class CampaignService:
@@ -128,14 +469,11 @@ class CampaignService:
         instance.delete()
 
     @classmethod
-    def schedule_initial_message(cls, campaign, visitors):
-        if not campaign.messages.first():
+    def schedule_initial_message(cls, campaign, visitor_ids):
+        message = Message.objects.get_message_tree_for_campaign(campaign.id).get_head_message()
+        if message is None:
             return
-        message = campaign.messages.first().get_head_message()
-        MessageService.schedule_message(
-            message=message,
-            receivers=WatiService.get_recievers_for_visitors(visitors)
-        )
+        MessageService.schedule_message(message=message, visitor_ids=visitor_ids)
 
 
 class SegmentationService:
@@ -149,8 +487,8 @@ class SegmentationService:
 
         segmentation = segmentation_serializer.save()
 
-        from app.tasks import sync_visitors_for_segmentation
-        sync_visitors_for_segmentation.delay()
+        from app.tasks import sync_visitors_for_segmentation_id
+        sync_visitors_for_segmentation_id.delay(segmentation.id)
 
         return segmentation
 
@@ -171,26 +509,54 @@ class SegmentationService:
         instance.delete()
 
     @classmethod
-    def update_visitor_segmentation_mapping(cls, segmentation):
-        visitors = Analytics.objects.get_unique_visitor_for_account(account=segmentation.account,
-                                                                    query=segmentation.rql_query)
-        visitor_segmentation_map_objs = []
-        created_objs = []
-        for visitor in visitors:
-            visitor_segmentation_map, created = VisitorSegmentationMap.objects.get_or_create(visitor_id=visitor,
-                                                                                        segmentation=segmentation)
-            visitor_segmentation_map_objs.append(visitor_segmentation_map)
-            if created:
-                created_objs.append(visitor_segmentation_map)
-        # VisitorSegmentationMap.objects.exclude(pk__in=[obj.pk for obj in visitor_segmentation_map_objs]).delete()
-
-        for campaign in segmentation.get_campaigns():
-            CampaignService.schedule_initial_message(
-                campaign=campaign,
-                visitors=[obj.visitor for obj in created_objs]
-            )
+    def update_visitor_segmentation_mapping(cls, segmentation, incremental=True):
+        """
+        Map the visitors matching the segment's RQL query to the segment.
+
+        When `incremental` is set and the query is additive and unchanged since
+        the last evaluation, only the analytics rows added after the segment's
+        watermark are scanned. Otherwise, and at least every
+        `SEGMENTATION_FULL_REBUILD_HOURS`, all of the account's analytics are scanned
+        and visitors no longer matching are removed from the segment.
+        Returns the ids of the visitors newly added to the segment.
+        """
+        rql_query = segmentation.rql_query
+        rebuild_due = (segmentation.rebuilt_at is None or
+                       segmentation.rebuilt_at < timezone.now() - timedelta(hours=settings.SEGMENTATION_FULL_REBUILD_HOURS))
+        full_rebuild = (not incremental or rebuild_due or
+                        segmentation.evaluated_rql_query != rql_query or
+                        not AnalyticsFilters.is_additive_query(rql_query))
+
+        after_id = None if full_rebuild else segmentation.evaluated_analytics_id
+        up_to_id = Analytics.objects.get_settled_max_id(after_id=after_id or 0)
+        if up_to_id is None and not full_rebuild:
+            return []
+
+        visitor_ids = Analytics.objects.get_visitor_ids_matching_query_for_account(account=segmentation.account,
+                                                                               query=rql_query,
+                                                                               after_id=after_id,
+                                                                               up_to_id=up_to_id)
+        evaluated = {
+            'evaluated_rql_query': rql_query,
+            'evaluated_analytics_id': up_to_id or segmentation.evaluated_analytics_id
+        }
+        if full_rebuild:
+            evaluated['rebuilt_at'] = timezone.now()
+
+        with transaction.atomic():
+            added_visitor_ids = VisitorSegmentationMap.objects.sync_visitors(segmentation=segmentation,
+                                                                            visitor_ids=visitor_ids,
+                                                                            remove_missing=full_rebuild)
+            Segmentation.objects.filter(id=segmentation.id).update(**evaluated)
+
+        if added_visitor_ids:
+            for campaign in segmentation.get_campaigns():
+                CampaignService.schedule_initial_message(
+                    campaign=campaign,
+                    visitor_ids=added_visitor_ids
+                )
 
-        return visitor_segmentation_map_objs
+        return added_visitor_ids
 
 
 class WatiService:
@@ -241,28 +607,19 @@ class WatiService:
         if not account:
             account = get_current_account()
 
-        WatiTemplate.objects.flush_wati_template_for_account(account=account)
-
         wati_attribute = WatiAttribute.objects.get_wati_attribute_for_account(account=account)
         wati = Wati(**wati_attribute.get_api_credentials())
 
-        page_number = 1
-        all_templates = []
-        while True:
-            templates = wati.get_templates(page_number=page_number)
-
-            if not templates:
-                break
-
-            all_templates.extend(templates)
-            page_number += 1
+        all_templates = run_async(AsyncWati(wati).get_all_templates())
 
         instances = []
         for template in all_templates:
             instance = WatiTemplate(template=template, account=account)
             instances.append(instance)
 
-        WatiTemplate.objects.bulk_create(instances)
+        with transaction.atomic():
+            WatiTemplate.objects.flush_wati_template_for_account(account=account)
+            WatiTemplate.objects.bulk_create(instances)
 
     @classmethod
     def process_wati_event(cls, event_body):
@@ -276,7 +633,7 @@ class WatiService:
     def process_message_delivered(cls, event_body):
         wati_message_id = event_body.get('whatsappMessageId')
         try:
-            wati_message = WatiMessage.objects.get(wati_message_id=wati_message_id)
+            wati_message = WatiMessage.objects.select_related('message', 'visitor').get(wati_message_id=wati_message_id)
         except WatiMessage.DoesNotExist:
             return
         if wati_message.message.action == Message.ON_MESSAGE_DELIVERED:
@@ -284,14 +641,14 @@ class WatiService:
             for message in messages:
                 MessageService.schedule_message(
                     message,
-                    WatiService.get_recievers_for_visitors(wati_message.visitor)
+                    visitor_ids=[wati_message.visitor_id]
                 )
 
     @classmethod
     def process_message_read(cls, event_body):
         wati_message_id = event_body.get('whatsappMessageId')
         try:
-            wati_message = WatiMessage.objects.get(wati_message_id=wati_message_id)
+            wati_message = WatiMessage.objects.select_related('message', 'visitor').get(wati_message_id=wati_message_id)
         except WatiMessage.DoesNotExist:
             return
         if wati_message.message.action == Message.ON_MESSAGE_READ:
@@ -299,14 +656,14 @@ class WatiService:
             for message in messages:
                 MessageService.schedule_message(
                     message,
-                    WatiService.get_recievers_for_visitors(wati_message.visitor)
+                    visitor_ids=[wati_message.visitor_id]
                 )
     
     @classmethod
     def process_message_replied(cls, event_body):
         wati_message_id = event_body.get('whatsappMessageId')
         try:
-            wati_message = WatiMessage.objects.get(wati_message_id=wati_message_id)
+            wati_message = WatiMessage.objects.select_related('message', 'visitor').get(wati_message_id=wati_message_id)
         except WatiMessage.DoesNotExist:
             return
         if wati_message.message.action == Message.ON_MESSAGE_REPLIED:
@@ -314,9 +671,161 @@ class WatiService:
             for message in messages:
                 MessageService.schedule_message(
                     message,
-                    WatiService.get_recievers_for_visitors(wati_message.visitor)
+                    visitor_ids=[wati_message.visitor_id]
                 )
 
+    @classmethod
+    def send_template_message(cls, message, audience_batch):
+        """
+        Send `message` to the visitors of `audience_batch` in chunks of
+        `WATI_SEND_CHUNK_SIZE`, each taking a token from the account's rate
+        limiting bucket. Receivers are read from the database chunk by chunk,
+        and the batch's `sent` count is updated after every chunk, so
+        retrying a failed send resumes with the first chunk not sent.
+
+        Only a chunk Wati never took in raises `WatiRequestNotSent` to be
+        retried. A chunk failing after it may have been received, on a
+        server error or a read timeout, is not sent again: its visitors are
+        added to the batch's `uncertain_visitor_ids` and the send goes on.
+
+        Every chunk is only sent after the batch was found still dispatched with
+        the token of `audience_batch`, touching `updated`, and its progress is
+        written the same way. The send stops once the batch was dispatched again.
+        Returns the number of visitors sent to.
+        """
+        account = message.campaign.account
+        wati_attribute = WatiAttribute.objects.get_wati_attribute_for_account(account=account)
+        if not wati_attribute.connected:
+            MessageAudienceBatch.objects.complete_audience_batch(audience_batch)
+            return 0
+
+        wati = Wati(**wati_attribute.get_api_credentials())
+        bucket = TokenBucket(f'wati:send:bucket:{account.id}',
+                             rate=settings.WATI_SEND_RATE_LIMIT,
+                             capacity=settings.WATI_SEND_BURST)
+
+        sent = audience_batch.sent
+        if sent:
+            logger.info(f'Resuming audience batch {audience_batch.id} of message {message.id} after {sent} visitors')
+
+        visitor_ids = audience_batch.visitor_ids
+        while sent < len(visitor_ids):
+            chunk = visitor_ids[sent:sent + settings.WATI_SEND_CHUNK_SIZE]
+            # Visitors deleted since the message was scheduled are skipped
+            visitors = list(Visitor.objects.filter(id__in=chunk).only('id', 'name', 'whatsapp_number'))
+            uncertain = False
+            if visitors:
+                if not MessageAudienceBatch.objects.update_dispatched_audience_batch(audience_batch):
+                    logger.warning(f'Audience batch {audience_batch.id} of message {message.id} was dispatched '
+                                   f'again, stopping before sending after {sent} visitors')
+                    return sent
+                bucket.acquire()
+                try:
+                    wati.send_tempate_messages(
+                        template_name=message.template,
+                        broadcast_name=message.campaign.name,
+                        recievers=cls.get_recievers_for_visitors(visitors)
+                    )
+                except requests.RequestException as exc:
+                    if not was_request_received(exc):
+                        raise WatiRequestNotSent(str(exc)) from exc
+                    uncertain = True
+                    logger.error(f'Sending message {message.id} to {len(visitors)} visitors of audience batch '
+                                 f'{audience_batch.id} failed after reaching Wati, not sending it again: {exc}')
+            sent += len(chunk)
+            with transaction.atomic():
+                if uncertain:
+                    dispatched = MessageAudienceBatch.objects.record_uncertain_visitors(
+                        audience_batch, sent=sent, visitor_ids=[visitor.id for visitor in visitors]
+                    )
+                else:
+                    dispatched = MessageAudienceBatch.objects.update_dispatched_audience_batch(audience_batch,
+                                                                                                 sent=sent)
+                    cls.record_sent_messages(message=message, visitors=visitors)
+            if not dispatched:
+                logger.warning(f'Audience batch {audience_batch.id} of message {message.id} was dispatched again, '
+                               f'stopping after {sent} visitors')
+                return sent
+
+        MessageAudienceBatch.objects.complete_audience_batch(audience_batch)
+        return sent
+
+    @classmethod
+    def record_sent_messages(cls, message, visitors):
+        """
+        Record `message` as sent to `visitors` and schedule looking up the
+        Wati ids of the sent messages, leaving the sending task free. The
+        lookup only covers the messages recorded here, so the tasks of the
+        chunks of a message never look up the same messages.
+        """
+        wati_messages = WatiMessage.objects.create_pending_wati_messages(message=message, visitors=visitors)
+        if wati_messages:
+            from app.tasks import correlate_wati_messages
+            wati_message_ids = [wati_message.id for wati_message in wati_messages]
+            transaction.on_commit(lambda: correlate_wati_messages.apply_async(
+                [message.id, wati_message_ids], countdown=settings.WATI_CORRELATION_DELAY
+            ))
+        return wati_messages
+
+    @classmethod
+    def correlate_wati_messages(cls, message, wati_message_ids=None):
+        """
+        Fill in the Wati ids of the pending sent messages of `message`, only
+        those of `wati_message_ids` when it is given. Each is
+        matched to the message of its template sent to the visitor's number
+        within `WATI_CORRELATION_WINDOW` seconds of it, replies and other sends
+        are not taken for it. Lookups run concurrently at no more than
+        `WATI_CORRELATION_RATE_LIMIT` per second, and messages still unmatched
+        after `WATI_CORRELATION_MAX_ATTEMPTS` lookups are marked as failed.
+        Returns the number of messages correlated and of those still pending.
+        """
+        wati_messages = list(WatiMessage.objects.get_pending_wati_messages(
+            message=message, wati_message_ids=wati_message_ids
+        ))
+        if not wati_messages:
+            return 0, 0
+
+        account = message.campaign.account
+        wati_attribute = WatiAttribute.objects.get_wati_attribute_for_account(account=account)
+        wati = AsyncWati(Wati(**wati_attribute.get_api_credentials()),
+                         rate_limit=settings.WATI_CORRELATION_RATE_LIMIT)
+
+        numbers = list({wati_message.visitor.whatsapp_number for wati_message in wati_messages})
+        recent_messages = run_async(wati.get_recent_messages_for_numbers(numbers))
+
+        # Ids already given to a sent message, by this or another lookup, are not matched again
+        item_ids = [item.get('id') for items in recent_messages.values() if not isinstance(items, Exception)
+                    for item in items]
+        matched_ids = set(WatiMessage.objects.filter(wati_message_id__in=item_ids)
+                          .values_list('wati_message_id', flat=True))
+
+        correlated, pending = 0, 0
+        for wati_message in wati_messages:
+            items = recent_messages[wati_message.visitor.whatsapp_number]
+            if isinstance(items, Exception):
+                logger.warning(f'Could not get the Wati id of message {message.id} '
+                               f'sent to visitor {wati_message.visitor_id}: {items}')
+                items = []
+
+            wati_message.correlation_attempts += 1
+            wati_message.wati_message_id = find_sent_template_message_id(
+                items, template_name=message.template, sent_at=wati_message.sent_at,
+                window=settings.WATI_CORRELATION_WINDOW, exclude=matched_ids
+            )
+            if wati_message.wati_message_id:
+                matched_ids.add(wati_message.wati_message_id)
+                correlated += 1
+            elif wati_message.correlation_attempts >= settings.WATI_CORRELATION_MAX_ATTEMPTS:
+                wati_message.correlation_failed = True
+                logger.warning(f'Gave up on the Wati id of message {message.id} sent to visitor '
+                               f'{wati_message.visitor_id} after {wati_message.correlation_attempts} attempts')
+            else:
+                pending += 1
+
+        WatiMessage.objects.bulk_update(wati_messages, ['wati_message_id', 'correlation_attempts',
+                                                        'correlation_failed'])
+        return correlated, pending
+
     @classmethod
     def get_recievers_for_visitors(cls, visitors):
         receivers = []
@@ -350,7 +859,7 @@ class MessageService:
             visitor_segmentation_map = VisitorSegmentationMap.objects.filter(segmentation=message.campaign.segment)
             CampaignService.schedule_initial_message(
                 campaign=message.campaign,
-                visitors=[obj.visitor for obj in visitor_segmentation_map]
+                visitor_ids=visitor_segmentation_map.values_list('visitor_id', flat=True)
             )
 
         return message
@@ -360,7 +869,41 @@ class MessageService:
         instance.delete()
 
     @classmethod
-    def schedule_message(cls, message, receivers):
-        eta = timezone.now() + timedelta(minutes=message.schedule)
+    def schedule_message(cls, message, visitor_ids):
+        """
+        Persist the audience of `message` in batches due after the message's
+        delay, they are queued for sending by `dispatch_due_messages`.
+        """
+        send_at = timezone.now() + timedelta(minutes=message.schedule)
+        return MessageAudienceBatch.objects.create_audience_batches(message=message,
+                                                                    visitor_ids=visitor_ids,
+                                                                    send_at=send_at)
+
+    @classmethod
+    def dispatch_due_messages(cls):
+        """
+        Queue a `schedule_message` task for every audience batch that is due,
+        claiming at most `MESSAGE_DISPATCH_BATCH_SIZE` batches per query.
+        Dispatched batches whose task made no progress for `MESSAGE_DISPATCH_TIMEOUT`
+        seconds are rescheduled first. Returns the number dispatched.
+        """
         from app.tasks import schedule_message
-        schedule_message.apply_async([message.id, receivers], eta=eta)
+
+        updated_before = timezone.now() - timedelta(seconds=settings.MESSAGE_DISPATCH_TIMEOUT)
+        rescheduled = MessageAudienceBatch.objects.reschedule_stale_audience_batches(
+            updated_before=updated_before
+        )
+        if rescheduled:
+            logger.warning(f'Rescheduled {rescheduled} audience batches without progress in time')
+
+        dispatched = 0
+        for _ in range(settings.MESSAGE_DISPATCH_MAX_BATCHES):
+            due_batches = MessageAudienceBatch.objects.claim_due_audience_batches(
+                limit=settings.MESSAGE_DISPATCH_BATCH_SIZE
+            )
+            for message_id, audience_batch_id, dispatch_token in due_batches:
+                schedule_message.delay(message_id, audience_batch_id, dispatch_token)
+            dispatched += len(due_batches)
+            if len(due_batches) < settings.MESSAGE_DISPATCH_BATCH_SIZE:
+                break
+        return dispatched
@@ -0,0 +1,46 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from app.caches import get_account_site_cache, get_message_tree_cache, get_visitor_resolution_cache
+from app.models import Account, Message, Visitor
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_account_sites(sender, instance, **kwargs):
+    # The previous site of a renamed account is not known here, so drop all entries.
+    # Other processes could load the old row again until the change is committed.
+    transaction.on_commit(get_account_site_cache().clear)
+
+
+@receiver(pre_delete, sender=Visitor)
+def invalidate_deleted_visitor(sender, instance, **kwargs):
+    cache = get_visitor_resolution_cache()
+    for account_id in instance.account.values_list('id', flat=True):
+        cache.invalidate(account_id, instance.device_uuid)
+
+
+@receiver(m2m_changed, sender=Visitor.account.through)
+def invalidate_visitor_account_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        account_ids = [instance.id]
+        visitors = Visitor.objects.filter(id__in=pk_set) if pk_set else instance.visitors.all()
+    else:
+        account_ids = pk_set or instance.account.values_list('id', flat=True)
+        visitors = [instance]
+
+    cache = get_visitor_resolution_cache()
+    for visitor in visitors:
+        for account_id in account_ids:
+            cache.invalidate(account_id, visitor.device_uuid)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def invalidate_message_tree(sender, instance, **kwargs):
+    campaign_id = instance.campaign_id
+    transaction.on_commit(lambda: get_message_tree_cache().invalidate(campaign_id))
@@ -1,10 +1,18 @@
-from celery import shared_task
+import time
+
+from celery import shared_task, chord, group
 from celery.utils.log import get_task_logger
 from datetime import datetime
+from django.conf import settings
+from redis.exceptions import LockError
 
-from app.models import WatiAttribute, Segmentation, Message
-from app.services import WatiService, SegmentationService, VisitorService
-from app.wati import Wati
+from app.models import Account, WatiAttribute, Segmentation, Message, MessageAudienceBatch, AnalyticsExport
+from app.services import (WatiService, SegmentationService, VisitorService, AnalyticsService,
+                          AnalyticsRollupService, AnalyticsExportService, MessageService)
+from app.ingestion_buffer import AnalyticsIngestionBuffer
+from app import partitions
+from app.redis_client import get_redis_connection
+from app.wati import WatiRequestNotSent
 
 
 logger = get_task_logger(__name__)
@@ -19,33 +27,172 @@ def update_wati_template():
 
 @shared_task
 def sync_visitors_name():
-    wati_attributes = WatiAttribute.objects.filter(connected=True)
-    for wati_attribute in wati_attributes:
-        VisitorService.sync_name_for_visitors_for_account(account=wati_attribute.account)
+    '''
+    Fan out the name sync of every account connected to Wati to its own task.
+    '''
+    account_ids = WatiAttribute.objects.filter(connected=True).values_list('account_id', flat=True)
+    group(sync_visitors_name_for_account.s(account_id) for account_id in account_ids).delay()
+
+
+@shared_task
+def sync_visitors_name_for_account(account_id: int):
+    '''
+    Fill in the names of the visitors of an account from their Wati contacts.
+    '''
+    account = Account.objects.get(id=account_id)
+    named = VisitorService.sync_name_for_visitors_for_account(account=account)
+    logger.info(f'Named {named} visitors of account {account_id}')
 
 
 @shared_task
 def sync_visitors_for_segmentation():
-    segmentations = Segmentation.objects.all()
-    for segmentation in segmentations:
-        SegmentationService.update_visitor_segmentation_mapping(segmentation=segmentation)
+    '''
+    Fan out the evaluation of every segmentation to its own task and
+    report the run once all of them have finished.
+    '''
+    segmentation_ids = list(Segmentation.objects.order_by('id').values_list('id', flat=True))
+    if not segmentation_ids:
+        return
+
+    logger.info(f'Evaluating {len(segmentation_ids)} segmentations')
+    chord(
+        sync_visitors_for_segmentation_id.s(segmentation_id) for segmentation_id in segmentation_ids
+    )(report_segmentation_sync.s(started_at=time.time()))
+
+
+@shared_task
+def sync_visitors_for_segmentation_id(segmentation_id: int):
+    '''
+    Evaluate a single segmentation, skipping it when another worker
+    is already evaluating the same segmentation.
+    '''
+    started_at = time.time()
+    result = {'segmentation_id': segmentation_id, 'status': 'synced', 'added': 0, 'seconds': 0}
+
+    lock = get_redis_connection().lock(f'segmentation:sync:{segmentation_id}',
+                                       timeout=settings.SEGMENTATION_SYNC_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info(f'Segmentation {segmentation_id} is already being evaluated, skipping')
+        result['status'] = 'skipped'
+        return result
+
+    try:
+        segmentation = Segmentation.objects.filter(id=segmentation_id).first()
+        if segmentation is None:
+            result['status'] = 'missing'
+            return result
+        added = SegmentationService.update_visitor_segmentation_mapping(segmentation=segmentation)
+        result['added'] = len(added)
+    except Exception:
+        # Reported to the chord callback instead of raising, so one failing
+        # segmentation does not fail the report of the whole run.
+        logger.exception(f'Failed to evaluate segmentation {segmentation_id}')
+        result['status'] = 'failed'
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning(f'Lock of segmentation {segmentation_id} expired before the evaluation finished')
+
+    result['seconds'] = round(time.time() - started_at, 3)
+    logger.info(f'Evaluated segmentation {segmentation_id}: status={result["status"]} '
+                f'added={result["added"]} seconds={result["seconds"]}')
+    return result
+
+
+@shared_task
+def report_segmentation_sync(results: list, started_at: float):
+    '''
+    Chord callback of `sync_visitors_for_segmentation`, logs the outcome of the run.
+    '''
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+
+    slowest = max(results, key=lambda result: result['seconds'])
+    logger.info(f'Evaluated {len(results)} segmentations in {round(time.time() - started_at, 3)}s: '
+                f'{" ".join(f"{status}={count}" for status, count in sorted(statuses.items()))} '
+                f'added={sum(result["added"] for result in results)} '
+                f'slowest={slowest["segmentation_id"]} ({slowest["seconds"]}s)')
 
 
 @shared_task
-def schedule_message(message_id: int, recievers: list):
+def drain_analytics_ingestion_buffer():
+    '''
+    Flush the write-behind analytics streams of every account into the database.
+    '''
+    buffer = AnalyticsIngestionBuffer()
+    for account_id in buffer.get_account_ids():
+        ingested, dropped = AnalyticsService.drain_buffered_analytics(account_id=account_id)
+        stats = buffer.get_stats(account_id)
+        logger.info(f'Drained analytics buffer for account {account_id}: ingested={ingested} '
+                    f'dropped={dropped} length={stats["length"]} pending={stats["pending"]} '
+                    f'oldest_age_seconds={stats["oldest_age_seconds"]}')
+
+
+@shared_task
+def maintain_analytics_partitions():
+    '''
+    Create upcoming analytics partitions and remove the expired ones.
+    '''
+    created, removed = partitions.maintain_analytics_partitions()
+    logger.info(f'Analytics partitions created={created} removed={removed}')
+
+
+@shared_task
+def rollup_analytics():
+    '''
+    Fold new analytics rows into the hourly and daily rollups.
+    '''
+    rolled_up = AnalyticsRollupService.rollup_analytics()
+    logger.info(f'Rolled up analytics id range of {rolled_up}')
+
+
+@shared_task
+def export_analytics(analytics_export_id: int):
+    '''
+    Write the file of an analytics export.
+    '''
+    analytics_export = AnalyticsExport.objects.get(id=analytics_export_id)
+    AnalyticsExportService.run_export(analytics_export)
+    logger.info(f'Exported analytics to {analytics_export.file.name}')
+
+
+@shared_task(autoretry_for=(WatiRequestNotSent,), retry_backoff=True,
+             max_retries=settings.WATI_SEND_MAX_RETRIES)
+def schedule_message(message_id: int, audience_batch_id: int, dispatch_token: str = None):
     '''
     This function is invoked to schedule a message.
+    Sends it to the visitors of an audience batch, retries resume from the last chunk sent.
+    Only sends Wati never took in are retried, a retry could otherwise send a chunk twice.
+    Nothing is sent unless the batch is still dispatched with `dispatch_token`.
     '''
-    message = Message.objects.get(id=message_id)
-    account = message.campaign.account
-    wati_attribute = WatiAttribute.objects.get_wati_attribute_for_account(account=account)
+    message = Message.objects.select_related('campaign__account').get(id=message_id)
+    audience_batch = MessageAudienceBatch.objects.get(id=audience_batch_id, message=message)
+    audience_batch.dispatch_token = dispatch_token
+    if not MessageAudienceBatch.objects.update_dispatched_audience_batch(audience_batch):
+        logger.info(f'Audience batch {audience_batch_id} of message {message_id} is sent or was dispatched again')
+        return
+    sent = WatiService.send_template_message(message=message, audience_batch=audience_batch)
+    logger.info(f'Sent message {message_id} to {sent} visitors of audience batch {audience_batch_id}')
 
-    if wati_attribute.connected:
 
-        wati = Wati(**wati_attribute.get_api_credentials())
-        wati.send_tempate_messages(
-            template_name=message.template,
-            broadcast_name=message.campaign.name,
-            recievers=recievers,
-            message=message
-        )
+@shared_task
+def dispatch_due_messages():
+    '''
+    Queue the sending of the audience batches of messages that are due.
+    '''
+    dispatched = MessageService.dispatch_due_messages()
+    logger.info(f'Dispatched {dispatched} due audience batches')
+
+
+@shared_task
+def correlate_wati_messages(message_id: int, wati_message_ids: list = None):
+    '''
+    Look up the Wati ids of the messages sent for a message, only those of `wati_message_ids` when given.
+    '''
+    message = Message.objects.select_related('campaign__account').get(id=message_id)
+    correlated, pending = WatiService.correlate_wati_messages(message=message, wati_message_ids=wati_message_ids)
+    logger.info(f'Correlated {correlated} sent messages of message {message_id}, {pending} pending')
+    if pending:
+        correlate_wati_messages.apply_async([message_id, wati_message_ids], countdown=settings.WATI_CORRELATION_DELAY)
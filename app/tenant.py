@@ -1,3 +1,5 @@
+from urllib.parse import urlparse
+
 try:
     from threading import local
 except ImportError:
@@ -28,3 +30,19 @@ def get_current_account():
     Will return None if the account is not set
     """
     return getattr(_thread_locals, "account", None)
+
+
+def get_request_site(request):
+    """
+    Utils to get the site (netloc of the Origin header) a request was sent from.
+    The parsed value is kept on the request so the authentication backend
+    and the permission classes parse the header only once.
+    Will return None if the request has no Origin header.
+    """
+    if not hasattr(request, '_origin_site'):
+        site = request.META.get('HTTP_ORIGIN')
+        if site:
+            parsed_url = urlparse(site)
+            site = parsed_url.netloc.strip()
+        request._origin_site = site
+    return request._origin_site
@@ -1,3 +1,531 @@
-from django.test import TestCase
+import json
+import threading
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+import redis
+import requests
+from dj_rql.qs import AN
+from py_rql.parser import RQLParser
+from django.core.management import call_command
+from django.db import connection, models
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from app.models import (Account, Analytics, Campaign, Message, MessageAudienceBatch, Segmentation, Visitor,
+                        WatiAttribute, WatiMessage)
+from app.caches import AccountSiteCache, MessageTreeCache
+from app.filters import AnalyticsFilters
+from app.services import WatiService
+from app.wati import AsyncWati, Wati, find_sent_template_message_id, run_async, was_request_received
+
+
+class IndexUsageTests(TestCase):
+    """
+    Query plan regression tests for the access paths indexed in migration 0018.
+    Sequential scans are disabled, so the planner only falls back to one when
+    no index can serve the query.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = Account.objects.create(name='Indexed', site='indexed.example.com')
+        other_account = Account.objects.create(name='Other', site='other.example.com')
+
+        cls.visitors = Visitor.objects.bulk_create([
+            Visitor(whatsapp_number=f'91000{index:05}', device_uuid=uuid.uuid4()) for index in range(50)
+        ])
+        cls.account.visitors.add(*cls.visitors)
+
+        now = timezone.now()
+        Analytics.objects.bulk_create([
+            # Every visitor has a tenth of its rows in the account
+            Analytics(account=cls.account if index % 10 == 1 else other_account,
+                      visitor=cls.visitors[index // 10 % len(cls.visitors)],
+                      page_name=f'page-{index % 20}',
+                      button_clicked=f'button-{index % 5}' if index % 3 == 0 else '',
+                      created=now - timedelta(minutes=index))
+            for index in range(2000)
+        ])
+
+        segmentation = Segmentation.objects.create(name='All', rql_query='', account=cls.account)
+        campaign = Campaign.objects.create(name='Campaign', segment=segmentation, account=cls.account)
+        message = Message.objects.create(campaign=campaign, template='template')
+        WatiMessage.objects.bulk_create([
+            WatiMessage(message=message, visitor=visitor, wati_message_id=f'wati-{index}' if index % 2 else None)
+            for index, visitor in enumerate(cls.visitors)
+        ])
+
+        with connection.cursor() as cursor:
+            for model in (Analytics, Visitor, WatiMessage):
+                cursor.execute(f'ANALYZE {model._meta.db_table}')
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute('RESET enable_seqscan')
+
+    def get_plan_indexes(self, queryset):
+        """
+        Names of the indexes the plan of `queryset` read rows from. Indexes of
+        analytics partitions are reported as the index they were created from.
+        The query is run, so indexes of empty partitions, which are picked
+        whatever they are, do not count.
+        """
+        plan = json.loads(queryset.explain(format='json', analyze=True))
+
+        def walk(node):
+            if 'Index Name' in node and node['Actual Rows']:
+                yield node['Index Name']
+            for child in node.get('Plans', []):
+                yield from walk(child)
+
+        index_names = list(walk(plan[0]['Plan']))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT coalesce(parent.relname, child.relname) FROM pg_class child '
+                'LEFT JOIN pg_inherits ON pg_inherits.inhrelid = child.oid '
+                'LEFT JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                'WHERE child.relname = ANY(%s)',
+                [index_names]
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def test_visitor_history_uses_account_visitor_index(self):
+        queryset = Analytics.objects.filter(account=self.account, visitor=self.visitors[1])
+        self.assertIn('analytics_account_visitor_idx', self.get_plan_indexes(queryset))
+
+    def test_time_range_uses_account_created_index(self):
+        now = timezone.now()
+        queryset = Analytics.objects.filter(account=self.account, created__gte=now - timedelta(hours=1),
+                                            created__lt=now)
+        self.assertIn('analytics_account_created_idx', self.get_plan_indexes(queryset))
+
+    def test_segment_page_name_filter_uses_account_page_index(self):
+        queryset = AnalyticsFilters.filter_queryset(Analytics.objects.filter(account=self.account), 'page_name=page-1')
+        self.assertIn('analytics_account_page_idx', self.get_plan_indexes(queryset.values('visitor')))
+
+    def test_distinct_buttons_uses_partial_button_index(self):
+        queryset = Analytics.objects.get_distinct_button_clicked_for_account(account=self.account)
+        self.assertIn('analytics_account_button_idx', self.get_plan_indexes(queryset))
+
+    def test_segment_button_filters_use_partial_button_index(self):
+        # A button equal to a value implies the index's button_clicked <> ''
+        for query in ('button_clicked=button-1', 'in(button_clicked,(button-1,button-3))'):
+            with self.subTest(query=query):
+                queryset = AnalyticsFilters.filter_queryset(Analytics.objects.filter(account=self.account), query)
+                self.assertIn('analytics_account_button_idx', self.get_plan_indexes(queryset.values('visitor')))
+
+    def test_visitor_lookup_by_whatsapp_number_uses_index(self):
+        queryset = Visitor.objects.filter(whatsapp_number=self.visitors[0].whatsapp_number)
+        self.assertIn('visitor_whatsapp_number_idx', self.get_plan_indexes(queryset))
+
+    def test_wati_message_lookup_uses_partial_index(self):
+        queryset = WatiMessage.objects.filter(wati_message_id='wati-1')
+        self.assertIn('watimessage_wati_id_idx', self.get_plan_indexes(queryset))
+
+
+class AudienceBatchDispatchTests(TestCase):
+    """
+    Only the task holding the token of the latest claim of a batch may
+    write to it, and only batches without progress are claimed again.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        account = Account.objects.create(name='Dispatched', site='dispatched.example.com')
+        segmentation = Segmentation.objects.create(name='All', rql_query='', account=account)
+        campaign = Campaign.objects.create(name='Campaign', segment=segmentation, account=account)
+        cls.message = Message.objects.create(campaign=campaign, template='template')
+
+    def setUp(self):
+        MessageAudienceBatch.objects.create_audience_batches(message=self.message, visitor_ids=[1, 2, 3],
+                                                             send_at=timezone.now() - timedelta(minutes=1))
+        (_, self.batch_id, self.token), = MessageAudienceBatch.objects.claim_due_audience_batches(limit=10)
+
+    def get_batch(self, token):
+        audience_batch = MessageAudienceBatch.objects.get(id=self.batch_id)
+        audience_batch.dispatch_token = token
+        return audience_batch
+
+    def make_stale(self):
+        MessageAudienceBatch.objects.filter(id=self.batch_id).update(updated=timezone.now() - timedelta(hours=2))
+        return MessageAudienceBatch.objects.reschedule_stale_audience_batches(
+            updated_before=timezone.now() - timedelta(hours=1)
+        )
+
+    def test_claims_at_most_the_limit(self):
+        MessageAudienceBatch.objects.create_audience_batches(message=self.message, visitor_ids=range(5000),
+                                                             send_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(len(MessageAudienceBatch.objects.claim_due_audience_batches(limit=2)), 2)
+
+    def test_only_the_claiming_token_updates(self):
+        self.assertFalse(MessageAudienceBatch.objects.update_dispatched_audience_batch(
+            self.get_batch(str(uuid.uuid4())), sent=1
+        ))
+        self.assertTrue(MessageAudienceBatch.objects.update_dispatched_audience_batch(
+            self.get_batch(self.token), sent=1
+        ))
+        self.assertEqual(MessageAudienceBatch.objects.get(id=self.batch_id).sent, 1)
+
+    def test_batches_with_recent_progress_are_not_rescheduled(self):
+        MessageAudienceBatch.objects.update_dispatched_audience_batch(self.get_batch(self.token), sent=1)
+        rescheduled = MessageAudienceBatch.objects.reschedule_stale_audience_batches(
+            updated_before=timezone.now() - timedelta(hours=1)
+        )
+        self.assertEqual(rescheduled, 0)
+
+    def test_send_stops_before_the_next_chunk_once_dispatched_again(self):
+        visitors = Visitor.objects.bulk_create([
+            Visitor(whatsapp_number=f'93000{index:05}', device_uuid=uuid.uuid4()) for index in range(3)
+        ])
+        MessageAudienceBatch.objects.filter(id=self.batch_id).update(visitor_ids=[visitor.id for visitor in visitors])
+        WatiAttribute.objects.create(account=self.message.campaign.account, api_endpoint='http://wati.invalid',
+                                     api_key='key', connected=True)
+
+        # The batch is dispatched again once the first chunk was recorded
+        def dispatch_again(**kwargs):
+            MessageAudienceBatch.objects.filter(id=self.batch_id).update(dispatch_token=uuid.uuid4())
+
+        with self.settings(WATI_SEND_CHUNK_SIZE=1), mock.patch('app.services.TokenBucket'), \
+                mock.patch.object(WatiService, 'record_sent_messages', side_effect=dispatch_again), \
+                mock.patch.object(Wati, 'send_tempate_messages', return_value={}) as send:
+            sent = WatiService.send_template_message(message=self.message, audience_batch=self.get_batch(self.token))
+
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(sent, 1)
+        self.assertEqual(MessageAudienceBatch.objects.get(id=self.batch_id).sent, 1)
+
+    def test_superseded_task_can_not_write(self):
+        self.assertEqual(self.make_stale(), 1)
+        (_, _, token), = MessageAudienceBatch.objects.claim_due_audience_batches(limit=10)
+        self.assertNotEqual(token, self.token)
+        self.assertFalse(MessageAudienceBatch.objects.complete_audience_batch(self.get_batch(self.token)))
+        self.assertTrue(MessageAudienceBatch.objects.complete_audience_batch(self.get_batch(token)))
+
+
+class VisitorUpsertTests(TestCase):
+    def get_row_version(self, visitor):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT ctid::text FROM {Visitor._meta.db_table} WHERE id = %s', [visitor.id])
+            return cursor.fetchone()[0]
+
+    def test_existing_visitors_are_not_written(self):
+        visitor = Visitor.objects.create(name='Old', whatsapp_number='9500000000', device_uuid=uuid.uuid4())
+        row_version = self.get_row_version(visitor)
+        new_device_uuid = uuid.uuid4()
+
+        visitor_ids = Visitor.objects.upsert_visitors([
+            {'name': 'New', 'whatsapp_number': '9500000001', 'device_uuid': visitor.device_uuid},
+            {'name': 'New', 'whatsapp_number': '9500000002', 'device_uuid': new_device_uuid},
+        ])
+
+        self.assertEqual(visitor_ids[visitor.device_uuid], visitor.id)
+        self.assertEqual(visitor_ids[new_device_uuid], Visitor.objects.get(device_uuid=new_device_uuid).id)
+        self.assertEqual(self.get_row_version(visitor), row_version)
+        self.assertEqual(Visitor.objects.get(id=visitor.id).name, 'Old')
+
+
+class WatiStubHandler(BaseHTTPRequestHandler):
+    """
+    Answers with the statuses queued in `server.plan`, then with 200, and
+    records every request and the client connection it came from. The body
+    is built by `server.get_body(path)` when it is set.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self):
+        self.server.requests.append((self.command, self.path))
+        self.server.connections.add(self.client_address)
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        status, headers = self.server.plan.pop(0) if self.server.plan else (200, {})
+        if self.server.get_body:
+            body = json.dumps(self.server.get_body(self.path)).encode()
+        else:
+            body = json.dumps({'messageTemplates': [], 'contact_list': [{'fullName': 'Stub'}]}).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+
+class WatiClientTests(SimpleTestCase):
+    """
+    Retries and connection reuse of the Wati client against a local stub server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), WatiStubHandler)
+        cls.server.plan, cls.server.requests, cls.server.connections = [], [], set()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.api_endpoint = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.plan.clear()
+        self.server.requests.clear()
+        self.server.connections.clear()
+        self.server.get_body = None
+        self.wati = Wati(self.api_endpoint, 'key', max_retries=3, backoff=0.01)
+
+    def test_get_retries_throttling_and_server_errors(self):
+        self.server.plan.extend([(429, {'Retry-After': '0'}), (503, {})])
+        self.assertEqual(self.wati.get_templates(), [])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_get_gives_up_after_max_retries(self):
+        self.server.plan.extend([(500, {})] * 5)
+        with self.assertRaises(requests.HTTPError):
+            self.wati.get_templates()
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_post_server_error_is_not_retried(self):
+        self.server.plan.append((503, {}))
+        with self.assertRaises(requests.HTTPError):
+            self.wati.send_tempate_messages(template_name='template', broadcast_name='broadcast', recievers=[])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_post_throttling_is_retried(self):
+        self.server.plan.append((429, {'Retry-After': '0'}))
+        self.wati.send_tempate_messages(template_name='template', broadcast_name='broadcast', recievers=[])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def send_error(self):
+        with self.assertRaises(requests.RequestException) as context:
+            self.wati.send_tempate_messages(template_name='template', broadcast_name='broadcast', recievers=[])
+        return context.exception
+
+    def test_server_error_on_send_may_have_been_received(self):
+        self.server.plan.append((503, {}))
+        self.assertTrue(was_request_received(self.send_error()))
+
+    def test_throttled_send_was_not_received(self):
+        self.server.plan.extend([(429, {'Retry-After': '0'})] * 4)
+        self.assertFalse(was_request_received(self.send_error()))
+
+    def test_session_is_reused(self):
+        for _ in range(5):
+            Wati(self.api_endpoint, 'key').get_name_for_number('919999999999')
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def serve_templates(self, total, include_total=True):
+        def get_body(path):
+            query = parse_qs(urlparse(path).query)
+            page_size, page_number = int(query['pageSize'][0]), int(query['pageNumber'][0])
+            start = (page_number - 1) * page_size
+            body = {'messageTemplates': [{'id': index} for index in range(start, min(start + page_size, total))]}
+            if include_total:
+                body['link'] = {'pageNumber': page_number, 'pageSize': page_size, 'total': total}
+            return body
+        self.server.get_body = get_body
+
+    def test_all_templates_of_a_single_page(self):
+        self.serve_templates(total=3)
+        templates = run_async(AsyncWati(self.wati).get_all_templates(page_size=10))
+        self.assertEqual(len(templates), 3)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_all_templates_fans_out_over_the_reported_total(self):
+        self.serve_templates(total=45)
+        templates = run_async(AsyncWati(self.wati).get_all_templates(page_size=10))
+        self.assertEqual([template['id'] for template in templates], list(range(45)))
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_all_templates_without_a_total(self):
+        self.serve_templates(total=20, include_total=False)
+        templates = run_async(AsyncWati(self.wati).get_all_templates(page_size=10))
+        self.assertEqual(len(templates), 20)
+        self.assertEqual(len(self.server.requests), 3)
+
+
+class SentMessageMatchingTests(SimpleTestCase):
+    """
+    A sent message is only matched to a message of its template sent by us
+    within the window of its send time.
+    """
+
+    def setUp(self):
+        self.sent_at = timezone.now()
+
+    def item(self, id, seconds, owner=True, template='welcome'):
+        return {'id': id, 'owner': owner, 'templateName': template,
+                'created': (self.sent_at + timedelta(seconds=seconds)).isoformat()}
+
+    def find(self, items, **kwargs):
+        return find_sent_template_message_id(items, template_name='welcome', sent_at=self.sent_at,
+                                             window=300, **kwargs)
+
+    def test_closest_message_of_the_template(self):
+        items = [self.item('reply', 20, owner=False), self.item('other', 5, template='promo'),
+                 self.item('later', 200), self.item('ours', 10)]
+        self.assertEqual(self.find(items), 'ours')
+
+    def test_messages_outside_the_window(self):
+        self.assertIsNone(self.find([self.item('old', -3600), self.item('reply', 1, owner=False)]))
+
+    def test_matched_ids_are_excluded(self):
+        items = [self.item('first', 1), self.item('second', 2)]
+        self.assertEqual(self.find(items, exclude={'first'}), 'second')
+
+    def test_epoch_timestamps(self):
+        item = {'id': 'ours', 'owner': True, 'timestamp': str(int(self.sent_at.timestamp()))}
+        self.assertEqual(self.find([item]), 'ours')
+
+
+class SharedCounters:
+    """
+    The redis counters the caches keep their generations in, shared by the
+    cache instances of a test as redis is by processes.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key) or 0) + 1
+        return self.values[key]
+
+
+class AccountSiteCacheTests(SimpleTestCase):
+    """
+    Clearing the cache in one process drops the entries of every other one.
+    """
+
+    def setUp(self):
+        patcher = mock.patch('app.caches.get_redis_connection', return_value=SharedCounters())
+        self.redis = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api_process = AccountSiteCache(max_size=10, ttl=300, negative_ttl=60)
+        self.worker_process = AccountSiteCache(max_size=10, ttl=300, negative_ttl=60)
+
+    def test_clear_reaches_other_processes(self):
+        self.assertEqual(self.worker_process.get_account('site.example.com', lambda site: 'old'), 'old')
+        self.api_process.clear()
+        self.assertEqual(self.worker_process.get_account('site.example.com', lambda site: 'new'), 'new')
+
+    def test_unknown_site_is_found_once_registered(self):
+        self.assertIsNone(self.worker_process.get_account('new.example.com', lambda site: None))
+        self.assertIsNone(self.worker_process.get_account('new.example.com', lambda site: 'account'))
+        self.api_process.clear()
+        self.assertEqual(self.worker_process.get_account('new.example.com', lambda site: 'account'), 'account')
+
+    def test_entries_are_not_cached_without_redis(self):
+        self.redis.return_value = mock.Mock(get=mock.Mock(side_effect=redis.ConnectionError))
+        loader = mock.Mock(return_value='account')
+        for _ in range(2):
+            self.worker_process.get_account('site.example.com', loader)
+        self.assertEqual(loader.call_count, 2)
+
+
+class MessageTreeCacheTests(SimpleTestCase):
+    """
+    A campaign's tree changed in one process is loaded again by every other one.
+    """
+
+    def setUp(self):
+        patcher = mock.patch('app.caches.get_redis_connection', return_value=SharedCounters())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api_process = MessageTreeCache(max_size=10, ttl=60)
+        self.worker_process = MessageTreeCache(max_size=10, ttl=60)
+
+    def test_invalidate_reaches_other_processes(self):
+        self.assertEqual(self.worker_process.get_tree(1, lambda campaign_id: 'old'), 'old')
+        self.assertEqual(self.worker_process.get_tree(1, lambda campaign_id: 'new'), 'old')
+        self.api_process.invalidate(1)
+        self.assertEqual(self.worker_process.get_tree(1, lambda campaign_id: 'new'), 'new')
+
+    def test_other_campaigns_stay_cached(self):
+        self.worker_process.get_tree(2, lambda campaign_id: 'kept')
+        self.api_process.invalidate(1)
+        self.assertEqual(self.worker_process.get_tree(2, lambda campaign_id: 'reloaded'), 'kept')
+
+
+class MaintainAnalyticsPartitionsCommandTests(TestCase):
+
+    def test_reports_created_and_removed_partitions(self):
+        stdout = StringIO()
+        call_command('maintain_analytics_partitions', months_ahead=1, retention_months=0, stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Created partitions: '))
+        self.assertEqual(lines[1], 'Removed partitions: -')
+
+
+class AnnotatedAnalyticsFilters(AnalyticsFilters):
+    SELECT = True
+    FILTERS = [{
+        'filter': 'visitor_number',
+        'dynamic': True,
+        'field': models.CharField(),
+        'qs': AN(visitor_number=F('visitor__whatsapp_number')),
+    }]
+
+
+class CompiledQueryTests(TestCase):
+    """
+    Queries compiled once are applied with the annotations their filters need.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        account = Account.objects.create(name='Compiled', site='compiled.example.com')
+        visitors = Visitor.objects.bulk_create([
+            Visitor(whatsapp_number=f'94000{index:05}', device_uuid=uuid.uuid4()) for index in range(2)
+        ])
+        Analytics.objects.bulk_create([Analytics(account=account, visitor=visitor, page_name='home')
+                                       for visitor in visitors])
+        cls.visitor = visitors[0]
+
+    def test_annotated_filter(self):
+        # The prototype of the parent class is built first, as in a running process
+        AnalyticsFilters.for_queryset(Analytics.objects.none())
+        query = f'visitor_number={self.visitor.whatsapp_number}'
+        for _ in range(2):
+            queryset = AnnotatedAnalyticsFilters.filter_queryset(Analytics.objects.all(), query)
+            self.assertEqual([row.visitor_id for row in queryset], [self.visitor.id])
+
+    def test_queries_are_cached_per_filter_class(self):
+        query = 'page_name=home'
+        self.assertEqual(AnalyticsFilters.compile_query(query)[3], {'page_name'})
+        self.assertIsNot(AnalyticsFilters.compile_query(query), AnnotatedAnalyticsFilters.compile_query(query))
+
+    def test_additive_queries(self):
+        self.assertTrue(AnalyticsFilters.is_additive_query('and(page_name=home,ge(time_stayed,5))'))
+        self.assertFalse(AnalyticsFilters.is_additive_query('visitor=1'))
+
+    def test_additive_check_reuses_the_compiled_query(self):
+        query = 'page_name=additive'
+        with mock.patch('app.filters.RQLParser.parse_query', wraps=RQLParser.parse_query) as parse_query:
+            for _ in range(3):
+                AnalyticsFilters.is_additive_query(query)
+            AnalyticsFilters.filter_queryset(Analytics.objects.all(), query)
+        self.assertEqual(parse_query.call_count, 1)
@@ -0,0 +1,62 @@
+import time
+
+from app.redis_client import get_redis_connection
+
+
+# Refills the bucket for the time elapsed since its last use, then takes the
+# requested tokens if there are enough. Returns how long to wait otherwise.
+# Uses the redis clock, so every worker sees the same time.
+ACQUIRE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every process through redis, allowing bursts of
+    up to `capacity` calls and `rate` calls per second on average.
+    """
+
+    def __init__(self, key, rate, capacity):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.redis = get_redis_connection()
+        self.script = self.redis.register_script(ACQUIRE_SCRIPT)
+
+    def try_acquire(self, tokens=1):
+        """
+        Take `tokens` if available and return 0, otherwise the seconds to wait for them.
+        """
+        return float(self.script(keys=[self.key], args=[self.capacity, self.rate, tokens]))
+
+    def acquire(self, tokens=1):
+        """
+        Block until `tokens` are taken from the bucket.
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
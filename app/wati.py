@@ -1,30 +1,197 @@
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from email.utils import parsedate_to_datetime
+
 import requests
-from app.models import WatiMessage, Visitor
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses retried for every request. Server errors are only retried for
+# idempotent requests, a failed send may still have been delivered.
+RETRY_STATUSES = {429}
+IDEMPOTENT_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(api_endpoint):
+    """
+    Process wide session for a Wati endpoint, keeping its connections alive
+    between requests instead of opening a new one for every call.
+    """
+    with _sessions_lock:
+        session = _sessions.get(api_endpoint)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.WATI_POOL_MAX_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[api_endpoint] = session
+        return session
+
+
+class WatiRequestNotSent(Exception):
+    """
+    A request Wati never took in, it did not connect or was throttled,
+    so it is safe to send it again.
+    """
+
+
+def was_request_received(exc):
+    """
+    Whether the request that failed with `exc` may have reached Wati. Only
+    connect timeouts and throttling are known to have been turned away.
+    """
+    if isinstance(exc, requests.ConnectTimeout):
+        return False
+    response = getattr(exc, 'response', None)
+    return response is None or response.status_code != 429
+
+
+def get_retry_after(response):
+    """
+    Seconds to wait requested by the `Retry-After` header of `response`, if any.
+    """
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(retry_after) - timezone.now()).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_message_time(item):
+    """
+    Time a message of `getMessages` was created, None if it can not be read.
+    """
+    created = parse_datetime(item.get('created') or '')
+    if created is not None:
+        return created if timezone.is_aware(created) else timezone.make_aware(created, dt_timezone.utc)
+    try:
+        return datetime.fromtimestamp(int(item['timestamp']), tz=dt_timezone.utc)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def get_message_template_name(item):
+    """
+    Name of the template a message of `getMessages` was sent from, if it says.
+    """
+    return (item.get('templateName') or
+            (item.get('template') or {}).get('name') or
+            (item.get('broadcastMessage') or {}).get('templateName'))
+
+
+def find_sent_template_message_id(items, template_name, sent_at, window, exclude=()):
+    """
+    Id of the message among `items` that we sent from `template_name` closest
+    to `sent_at` and at most `window` seconds from it. Replies of the contact,
+    other templates and ids in `exclude` are never matched.
+    """
+    best_id, best_distance = None, None
+    for item in items:
+        if not item.get('owner') or item.get('id') in exclude:
+            continue
+        item_template_name = get_message_template_name(item)
+        if item_template_name is not None and item_template_name != template_name:
+            continue
+        created = get_message_time(item)
+        if created is None:
+            continue
+        distance = abs((created - sent_at).total_seconds())
+        if distance <= window and (best_distance is None or distance < best_distance):
+            best_id, best_distance = item['id'], distance
+    return best_id
+
 
 class Wati:
-    def __init__(self, api_endpoint, api_key):
+    def __init__(self, api_endpoint, api_key, connect_timeout=None, read_timeout=None,
+                 max_retries=None, backoff=None):
         self.api_endpoint = api_endpoint
         self.api_key = api_key
 
+        self.connect_timeout = connect_timeout or settings.WATI_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or settings.WATI_READ_TIMEOUT
+        self.max_retries = settings.WATI_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = settings.WATI_RETRY_BACKOFF if backoff is None else backoff
+
+        self.session = get_session(api_endpoint)
+
     def _get_headers(self):
         return {
             "Authorization": self.api_key
         }
 
-    def get_templates(self, page_size=500, page_number=1):
+    def _get_retry_delay(self, attempt, response=None):
+        retry_after = get_retry_after(response) if response is not None else None
+        if retry_after is None:
+            # Exponential backoff with full jitter
+            retry_after = random.uniform(0, self.backoff * 2 ** attempt)
+        return min(retry_after, settings.WATI_RETRY_MAX_DELAY)
+
+    def _request(self, method, url, read_timeout=None, max_retries=None, **kwargs):
+        """
+        Send a request through the endpoint's session, retrying throttled
+        requests and, for idempotent ones, server errors and failed
+        connections. Raises the last error once the retries are used up.
+        """
+        idempotent = method in ('GET', 'HEAD')
+        retry_statuses = IDEMPOTENT_RETRY_STATUSES if idempotent else RETRY_STATUSES
+        max_retries = self.max_retries if max_retries is None else max_retries
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+
+        attempt = 0
+        while True:
+            try:
+                res = self.session.request(method, url, headers=self._get_headers(), timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                # A request that never connected was not sent, so it is safe to retry
+                retryable = idempotent or isinstance(exc, requests.ConnectTimeout)
+                if not retryable or attempt >= max_retries:
+                    logger.warning(f'Wati {method} {url} failed: {exc}')
+                    raise
+                delay = self._get_retry_delay(attempt)
+            else:
+                if res.status_code not in retry_statuses or attempt >= max_retries:
+                    try:
+                        res.raise_for_status()
+                    except requests.HTTPError as exc:
+                        logger.warning(f'Wati {method} {url} failed: {exc}')
+                        raise
+                    return res
+                delay = self._get_retry_delay(attempt, response=res)
+
+            attempt += 1
+            logger.info(f'Retrying Wati {method} {url} in {delay:.2f}s (attempt {attempt} of {max_retries})')
+            time.sleep(delay)
+
+    def get_templates_page(self, page_size=500, page_number=1):
         url = f"{self.api_endpoint}/api/v1/getMessageTemplates"
         params = {
             "pageSize": page_size,
             "pageNumber": page_number
         }
-        try:
-            res = requests.get(url, params=params, headers=self._get_headers(), timeout=90)
-            res.raise_for_status()
-        except Exception as exc:
-            # TODO: Handle exceptions
-            print(str(exc))
-            raise exc
-        templates = res.json().get('messageTemplates')
+        res = self._request('GET', url, params=params)
+        return res.json()
+
+    def get_templates(self, page_size=500, page_number=1):
+        templates = self.get_templates_page(page_size=page_size, page_number=page_number).get('messageTemplates')
         return templates
 
     def get_messages_for_number(self, number, page_size=100, page_number=1):
@@ -33,59 +200,31 @@ class Wati:
             "pageSize": page_size,
             "pageNumber": page_number
         }
-        try:
-            res = requests.get(url, params=params, headers=self._get_headers(), timeout=90)
-            res.raise_for_status()
-        except Exception as exc:
-            # TODO: Handle exceptions
-            print(str(exc))
-            raise exc
+        res = self._request('GET', url, params=params)
         messages = res.json()
         return messages
 
-    def send_tempate_messages(self, template_name, broadcast_name, recievers, message):
+    def send_tempate_messages(self, template_name, broadcast_name, recievers):
         url = f"{self.api_endpoint}/api/v1/sendTemplateMessages"
         payload = {
             "template_name": template_name,
             "broadcast_name": broadcast_name,
             "receivers": recievers
         }
-        try:
-            res = requests.post(url, headers=self._get_headers(), json=payload, timeout=90)
-            res.raise_for_status()
-        except Exception as exc:
-            # TODO: Handle exceptions
-            print(str(exc))
-            raise exc
-        
-        self.add_wati_message_id_to_message_obj(recievers, message)
+        res = self._request('POST', url, json=payload)
         return res.json()
 
     def get_connection_status(self):
         url = f"{self.api_endpoint}/api/v1/getContacts"
         try:
-            res = requests.get(url, headers=self._get_headers(), timeout=10)
-            res.raise_for_status()
+            self._request('GET', url, read_timeout=10, max_retries=0)
             return True
-        except Exception as exc:
-            print(str(exc))
+        except requests.RequestException:
             return False
         
-    def add_wati_message_id_to_message_obj(self, receivers, message):
-        for receiver_obj in receivers:
-            receiver_phone_number = receiver_obj['whatsappNumber']
-            message_response = self.get_messages_for_number(
-                number=receiver_phone_number,
-                page_size=1
-            )
-
-            wati_message_id = message_response['messages']['items'][0]['id']
-            visitor = Visitor.objects.get(whatsapp_number=receiver_phone_number)
-            WatiMessage.objects.create(
-                wati_message_id=wati_message_id,
-                message=message,
-                visitor=visitor
-            )
+    def get_recent_messages_for_number(self, number, page_size=20):
+        message_response = self.get_messages_for_number(number=number, page_size=page_size)
+        return (message_response.get('messages') or {}).get('items') or []
 
     def get_contacts(self, whatsapp_number):
         url = f"{self.api_endpoint}/api/v1/getContacts"
@@ -95,13 +234,7 @@ class Wati:
             "value": whatsapp_number
         }]
         url += f'?attribute={attribute}'
-        try:
-            res = requests.get(url, headers=self._get_headers(), timeout=90)
-            res.raise_for_status()
-        except Exception as exc:
-            # TODO: Handle exceptions
-            print(str(exc))
-            raise exc
+        res = self._request('GET', url)
         contacts = res.json().get('contact_list')
         return contacts
 
@@ -110,3 +243,118 @@ class Wati:
         if contacts:
             contact = contacts[0]
             return contact.get('fullName')
+
+
+class AsyncWati:
+    """
+    asyncio variant of `Wati` for running many calls concurrently. The
+    blocking calls of `wati` run in threads over its pooled session, at
+    most `concurrency` at a time. Run its coroutines with `run_async`.
+    """
+
+    def __init__(self, wati, concurrency=None, rate_limit=None):
+        self.wati = wati
+        self.concurrency = concurrency or settings.WATI_MAX_CONCURRENCY
+        # Calls started per second, unlimited if not set
+        self.rate_limit = rate_limit
+
+        # Created in the running loop, asyncio primitives bind to the loop they are created in
+        self._semaphore = None
+        self._rate_limit_lock = None
+        self._next_call_at = 0
+
+    async def _wait_for_rate_limit(self):
+        if not self.rate_limit:
+            return
+        if self._rate_limit_lock is None:
+            self._rate_limit_lock = asyncio.Lock()
+
+        async with self._rate_limit_lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next_call_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_call_at = max(loop.time(), self._next_call_at) + 1 / self.rate_limit
+
+    async def _call(self, func, *args, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        await self._wait_for_rate_limit()
+        async with self._semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def get_templates(self, page_size=500, page_number=1):
+        return await self._call(self.wati.get_templates, page_size=page_size, page_number=page_number)
+
+    async def get_all_templates(self, page_size=500):
+        """
+        Templates of every page. The first page is fetched alone, the rest
+        concurrently once the total it reports tells how many there are.
+        Without a total, pages are fetched one by one until a short one.
+        """
+        first_page = await self._call(self.wati.get_templates_page, page_size=page_size, page_number=1)
+        all_templates = list(first_page.get('messageTemplates') or [])
+        if len(all_templates) < page_size:
+            return all_templates
+
+        total = (first_page.get('link') or {}).get('total')
+        if total is not None:
+            page_count = math.ceil(int(total) / page_size)
+            pages = await asyncio.gather(*(
+                self.get_templates(page_size=page_size, page_number=number)
+                for number in range(2, page_count + 1)
+            ))
+            for templates in pages:
+                all_templates.extend(templates or [])
+            return all_templates
+
+        page_number = 2
+        while True:
+            templates = await self.get_templates(page_size=page_size, page_number=page_number) or []
+            all_templates.extend(templates)
+            if len(templates) < page_size:
+                return all_templates
+            page_number += 1
+
+    async def get_messages_for_number(self, number, page_size=100, page_number=1):
+        return await self._call(self.wati.get_messages_for_number, number=number,
+                                page_size=page_size, page_number=page_number)
+
+    async def get_recent_messages_for_numbers(self, numbers):
+        """
+        Map each number to its recent messages, or to the exception raised looking them up.
+        """
+        messages = await asyncio.gather(*(
+            self._call(self.wati.get_recent_messages_for_number, number=number) for number in numbers
+        ), return_exceptions=True)
+        return dict(zip(numbers, messages))
+
+    async def get_contacts(self, whatsapp_number):
+        return await self._call(self.wati.get_contacts, whatsapp_number=whatsapp_number)
+
+    async def get_name_for_number(self, whatsapp_number):
+        return await self._call(self.wati.get_name_for_number, whatsapp_number=whatsapp_number)
+
+    async def get_names_for_numbers(self, whatsapp_numbers):
+        """
+        Map each number to its contact name, or to the exception raised looking it up.
+        """
+        names = await asyncio.gather(*(
+            self.get_name_for_number(whatsapp_number) for whatsapp_number in whatsapp_numbers
+        ), return_exceptions=True)
+        return dict(zip(whatsapp_numbers, names))
+
+
+def run_async(coroutine, max_workers=None):
+    """
+    Run `coroutine` to completion from synchronous code such as a Celery task.
+    The loop gets its own thread pool for the blocking calls of `AsyncWati`,
+    sized to `WATI_MAX_CONCURRENCY` rather than to the number of CPUs.
+    """
+    async def main():
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=max_workers or settings.WATI_MAX_CONCURRENCY)
+        )
+        return await coroutine
+
+    return asyncio.run(main())
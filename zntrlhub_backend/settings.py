@@ -121,7 +121,7 @@ REST_FRAMEWORK = {
         'app.backends.CustomAuthentication',
     ),
     'EXCEPTION_HANDLER': 'app.custom_exception_handler.custom_exception_handler',
-    'DEFAULT_FILTER_BACKENDS': ['dj_rql.drf.RQLFilterBackend'],
+    'DEFAULT_FILTER_BACKENDS': ['app.filters.PaginatedRQLFilterBackend'],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 20
 }
@@ -149,8 +149,10 @@ SWAGGER_SETTINGS = {
     },
 }
 
-CELERY_BROKER_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0")
-CELERY_RESULT_BACKEND = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0")
+
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_RESULT_EXTENDED = True
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_RESULT_SERIALIZER = 'json'
@@ -159,7 +161,109 @@ CELERY_STORE_ERRORS_EVEN_IF_IGNORED = True
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 CELERY_TIMEZONE = 'UTC'
 
+ANALYTICS_INGEST_BATCH_MAX_SIZE = int(os.environ.get("ANALYTICS_INGEST_BATCH_MAX_SIZE", 500))
+VISITOR_REPORT_BATCH_MAX_SIZE = int(os.environ.get("VISITOR_REPORT_BATCH_MAX_SIZE", 500))
+
+# Write-behind ingestion: events are appended to a redis stream per account and
+# drained into the database by the `drain_analytics_ingestion_buffer` task.
+ANALYTICS_INGEST_WRITE_BEHIND = os.environ.get("ANALYTICS_INGEST_WRITE_BEHIND", "false").lower() == "true"
+ANALYTICS_INGEST_BUFFER_MAX_LENGTH = int(os.environ.get("ANALYTICS_INGEST_BUFFER_MAX_LENGTH", 1000000))
+ANALYTICS_INGEST_DRAIN_BATCH_SIZE = int(os.environ.get("ANALYTICS_INGEST_DRAIN_BATCH_SIZE", 1000))
+ANALYTICS_INGEST_DRAIN_MAX_BATCHES = int(os.environ.get("ANALYTICS_INGEST_DRAIN_MAX_BATCHES", 50))
+ANALYTICS_INGEST_CLAIM_IDLE_MS = int(os.environ.get("ANALYTICS_INGEST_CLAIM_IDLE_MS", 300000))
+
+# Monthly partitions of the analytics table, maintained by `maintain_analytics_partitions`.
+# A retention of 0 keeps every partition, expired partitions are detached unless dropping is enabled.
+ANALYTICS_PARTITION_MONTHS_AHEAD = int(os.environ.get("ANALYTICS_PARTITION_MONTHS_AHEAD", 3))
+ANALYTICS_PARTITION_RETENTION_MONTHS = int(os.environ.get("ANALYTICS_PARTITION_RETENTION_MONTHS", 0))
+ANALYTICS_PARTITION_DROP_EXPIRED = os.environ.get("ANALYTICS_PARTITION_DROP_EXPIRED", "false").lower() == "true"
+
+# Incremental jobs over analytics (rollups, segment evaluation) only process rows up to
+# the highest id checkpointed at least the settle time ago.
+ANALYTICS_SETTLE_SECONDS = int(os.environ.get("ANALYTICS_SETTLE_SECONDS", 60))
+ANALYTICS_ROLLUP_BATCH_SIZE = int(os.environ.get("ANALYTICS_ROLLUP_BATCH_SIZE", 100000))
+
+# Segments with additive queries are evaluated incrementally and fully rebuilt at this interval.
+SEGMENTATION_FULL_REBUILD_HOURS = int(os.environ.get("SEGMENTATION_FULL_REBUILD_HOURS", 24))
+# Per process cache of compiled segment RQL queries.
+RQL_COMPILED_QUERY_CACHE_SIZE = int(os.environ.get("RQL_COMPILED_QUERY_CACHE_SIZE", 1000))
+
+# Expiry of the lock held while a segmentation is evaluated, so a crashed worker cannot hold it forever.
+SEGMENTATION_SYNC_LOCK_TIMEOUT = int(os.environ.get("SEGMENTATION_SYNC_LOCK_TIMEOUT", 900))
+
+# Cache of (account, device_uuid) -> visitor id used on the ingestion path.
+VISITOR_CACHE_MAX_SIZE = int(os.environ.get("VISITOR_CACHE_MAX_SIZE", 100000))
+VISITOR_CACHE_TTL = int(os.environ.get("VISITOR_CACHE_TTL", 300))
+VISITOR_CACHE_REDIS_ENABLED = os.environ.get("VISITOR_CACHE_REDIS_ENABLED", "false").lower() == "true"
+VISITOR_CACHE_REDIS_TTL = int(os.environ.get("VISITOR_CACHE_REDIS_TTL", 86400))
+
+# Numbers without a name in Wati are not looked up again by the name sync for this many seconds.
+VISITOR_NAME_MISS_BACKOFF = int(os.environ.get("VISITOR_NAME_MISS_BACKOFF", 86400))
+
+# Cache of Origin site -> Account used to authenticate anonymous tracking requests. Saving
+# or deleting an account invalidates it in every process through a generation in redis.
+ACCOUNT_SITE_CACHE_MAX_SIZE = int(os.environ.get("ACCOUNT_SITE_CACHE_MAX_SIZE", 10000))
+ACCOUNT_SITE_CACHE_TTL = int(os.environ.get("ACCOUNT_SITE_CACHE_TTL", 300))
+ACCOUNT_SITE_CACHE_NEGATIVE_TTL = int(os.environ.get("ACCOUNT_SITE_CACHE_NEGATIVE_TTL", 60))
+
+# Cache of campaign id -> message tree used when processing Wati events. Changing a message
+# invalidates the tree of its campaign in every process through a version in redis.
+MESSAGE_TREE_CACHE_MAX_SIZE = int(os.environ.get("MESSAGE_TREE_CACHE_MAX_SIZE", 10000))
+MESSAGE_TREE_CACHE_TTL = int(os.environ.get("MESSAGE_TREE_CACHE_TTL", 60))
+
+# Wati API client. Throttled requests, and server errors of reads, are retried with
+# jittered exponential backoff or after the server's Retry-After, capped at the max delay.
+WATI_CONNECT_TIMEOUT = float(os.environ.get("WATI_CONNECT_TIMEOUT", 5))
+WATI_READ_TIMEOUT = float(os.environ.get("WATI_READ_TIMEOUT", 30))
+WATI_MAX_RETRIES = int(os.environ.get("WATI_MAX_RETRIES", 3))
+WATI_RETRY_BACKOFF = float(os.environ.get("WATI_RETRY_BACKOFF", 0.5))
+WATI_RETRY_MAX_DELAY = float(os.environ.get("WATI_RETRY_MAX_DELAY", 30))
+WATI_POOL_MAX_SIZE = int(os.environ.get("WATI_POOL_MAX_SIZE", 10))
+# Concurrent calls of the async Wati client, should not exceed the pool size.
+WATI_MAX_CONCURRENCY = int(os.environ.get("WATI_MAX_CONCURRENCY", 10))
+# Template messages are sent in chunks of receivers, each chunk taking a token of the
+# account's bucket (refilled at the rate limit per second, holding up to the burst).
+# Failed sends are retried from the last chunk sent.
+WATI_SEND_CHUNK_SIZE = int(os.environ.get("WATI_SEND_CHUNK_SIZE", 100))
+WATI_SEND_RATE_LIMIT = float(os.environ.get("WATI_SEND_RATE_LIMIT", 1))
+WATI_SEND_BURST = int(os.environ.get("WATI_SEND_BURST", 5))
+WATI_SEND_MAX_RETRIES = int(os.environ.get("WATI_SEND_MAX_RETRIES", 5))
+
+# Visitors per audience batch, each batch is sent by its own task.
+MESSAGE_AUDIENCE_BATCH_SIZE = int(os.environ.get("MESSAGE_AUDIENCE_BATCH_SIZE", 1000))
+
+# Every minute due audience batches are claimed this many at a time, at most this many times.
+# Dispatched batches whose task made no progress for the timeout (seconds) are dispatched again.
+MESSAGE_DISPATCH_BATCH_SIZE = int(os.environ.get("MESSAGE_DISPATCH_BATCH_SIZE", 500))
+MESSAGE_DISPATCH_MAX_BATCHES = int(os.environ.get("MESSAGE_DISPATCH_MAX_BATCHES", 20))
+MESSAGE_DISPATCH_TIMEOUT = int(os.environ.get("MESSAGE_DISPATCH_TIMEOUT", 3600))
+
+# Sent messages are matched to their Wati ids after this delay, with at most this many lookups per second.
+WATI_CORRELATION_DELAY = int(os.environ.get("WATI_CORRELATION_DELAY", 30))
+WATI_CORRELATION_RATE_LIMIT = float(os.environ.get("WATI_CORRELATION_RATE_LIMIT", 5))
+# A sent message is matched to the message of its template sent within this many seconds
+# of it, and marked as failed after this many lookups without a match.
+WATI_CORRELATION_WINDOW = int(os.environ.get("WATI_CORRELATION_WINDOW", 300))
+WATI_CORRELATION_MAX_ATTEMPTS = int(os.environ.get("WATI_CORRELATION_MAX_ATTEMPTS", 5))
+
+# Rows fetched per round trip of the server side cursor of analytics exports.
+ANALYTICS_EXPORT_CHUNK_SIZE = int(os.environ.get("ANALYTICS_EXPORT_CHUNK_SIZE", 2000))
+
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+MEDIA_ROOT = os.environ.get("MEDIA_ROOT", os.path.join(BASE_DIR, 'media'))
+
+# Analytics export files are written by the worker and downloaded through the web
+# process, so they need storage both can reach. Set AWS_STORAGE_BUCKET_NAME (with the
+# usual AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY) to keep them in S3 and hand out
+# signed URLs valid for AWS_QUERYSTRING_EXPIRE seconds. The local MEDIA_ROOT only
+# works when web and worker share a filesystem, which separate dynos do not.
+AWS_STORAGE_BUCKET_NAME = os.environ.get("AWS_STORAGE_BUCKET_NAME")
+if AWS_STORAGE_BUCKET_NAME:
+    DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+    AWS_S3_REGION_NAME = os.environ.get("AWS_S3_REGION_NAME")
+    AWS_DEFAULT_ACL = None
+    AWS_QUERYSTRING_AUTH = True
+    AWS_QUERYSTRING_EXPIRE = int(os.environ.get("AWS_QUERYSTRING_EXPIRE", 300))
 
 LOGGING = {
     'version': 1,